@@ -0,0 +1,150 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import collections
+import copy
+import os
+import re
+import threading
+import time
+
+from impl.client.singleflight import SingleFlight
+from impl.common.metrics import InMemoryMetrics
+
+# Seconds a Procurement API resource is cached for. 0 disables the cache.
+API_CACHE_TTL_S = float(
+    os.environ.get('PROCUREMENT_CODELAB_API_CACHE_TTL_S', 30))
+
+# Maximum number of resources cached.
+API_CACHE_SIZE = int(os.environ.get('PROCUREMENT_CODELAB_API_CACHE_SIZE', 1000))
+
+_TIMESTAMP = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d{1,9}))?Z$')
+
+_Entry = collections.namedtuple('_Entry', ['value', 'as_of', 'expires'])
+
+
+def _parse_timestamp(value):
+    """Converts an RFC 3339 UTC timestamp to comparable nanoseconds, or None."""
+    match = _TIMESTAMP.match(value or '')
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1),
+                                            '%Y-%m-%dT%H:%M:%S'))
+    return seconds * 1000000000 + int((match.group(2) or '').ljust(9, '0'))
+
+
+class ResponseCache(object):
+    """A bounded LRU cache of API resources, each kept for ttl seconds.
+
+    Resources that were not found are cached too, as None. Each entry is
+    tagged with the time of the newest state it reflects: the resource's
+    updateTime, or the time of the event it was fetched for. A lookup for an
+    event carrying a later time misses, so the new state is fetched.
+
+    Concurrent misses for the same resource share a single fetch, even with
+    the cache disabled.
+
+    Hits, hits on resources that were not found, misses, and misses that
+    shared another fetch are counted in metrics as api_cache_hits,
+    api_cache_negative_hits, api_cache_misses and api_cache_coalesced.
+    """
+
+    def __init__(self, max_entries=API_CACHE_SIZE, ttl=API_CACHE_TTL_S,
+                 metrics=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
+        # Maps resource names to entries, least recently used first.
+        self._entries = collections.OrderedDict()
+        # Bumped by every invalidation. A fetched resource is only cached if
+        # none happened meanwhile, as it may predate the invalidation.
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, fetch, update_time=None):
+        """Returns the named resource, calling fetch() if it is not cached.
+
+        update_time is the time of the event that prompted the lookup, if
+        any. fetch() returns the resource, or None if it was not found; if it
+        raises an exception, nothing is cached, and the exception is raised
+        to every caller sharing the fetch.
+        """
+        as_of = _parse_timestamp(update_time)
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None and self._usable(entry, update_time, as_of):
+                self._entries[name] = entry
+                self.hits += 1
+                self.metrics.increment('api_cache_negative_hits'
+                                       if entry.value is None
+                                       else 'api_cache_hits')
+                return copy.deepcopy(entry.value)
+            self.misses += 1
+            invalidations = self._invalidations
+        self.metrics.increment('api_cache_misses')
+
+        def load():
+            value = fetch()
+            if self.ttl > 0:
+                self._put(name, value, as_of, invalidations)
+            return value
+
+        if update_time is not None and as_of is None:
+            # A fetch in flight may predate an event that cannot be compared.
+            return load()
+        value, shared = self._flights.do(name, load, as_of)
+        if shared:
+            self.metrics.increment('api_cache_coalesced')
+        return copy.deepcopy(value)
+
+    def _usable(self, entry, update_time, as_of):
+        if entry.expires <= time.time():
+            return False
+        if update_time is None:
+            return True
+        # An event with a time that cannot be compared may be newer.
+        return (as_of is not None and entry.as_of is not None and
+                as_of <= entry.as_of)
+
+    def _put(self, name, value, as_of, invalidations):
+        if value is not None:
+            updated = _parse_timestamp(value.get('updateTime'))
+            if updated is not None and (as_of is None or updated > as_of):
+                as_of = updated
+        entry = _Entry(copy.deepcopy(value), as_of, time.time() + self.ttl)
+        with self._lock:
+            if self._invalidations != invalidations:
+                return
+            self._entries.pop(name, None)
+            self._entries[name] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        """Drops the named resource, after it was changed."""
+        with self._lock:
+            self._entries.pop(name, None)
+            self._invalidations += 1
+        self._flights.forget(name)
+
+    def hit_rate(self):
+        """Returns the share of lookups answered from the cache, if any."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return float(self.hits) / lookups if lookups else None
@@ -0,0 +1,144 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+
+from impl.client.transport import pooled_http
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:
+    get_static_doc = None
+
+# Directory discovery documents are cached in, across process restarts.
+DISCOVERY_CACHE_DIR = os.environ.get(
+    'PROCUREMENT_CODELAB_DISCOVERY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'procurement-codelab',
+                 'discovery'))
+
+# Age after which a cached discovery document is fetched again.
+DISCOVERY_MAX_AGE_S = int(
+    os.environ.get('PROCUREMENT_CODELAB_DISCOVERY_MAX_AGE_S', 86400))
+
+# Where discovery documents are fetched from, tried in order, as build() does.
+_DISCOVERY_URLS = (
+    'https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest',
+    'https://{api}.googleapis.com/$discovery/rest?version={version}',
+)
+
+# Bumped whenever the layout of the cache changes, so that older files are
+# never read back.
+_CACHE_FORMAT = 1
+
+_lock = threading.Lock()
+# The built service of each API version.
+_services = {}
+
+
+def _cache_path(api, version):
+    return os.path.join(DISCOVERY_CACHE_DIR, '{}.{}.v{}.json'.format(
+        api, version, _CACHE_FORMAT))
+
+
+def _read_cache(api, version, max_age):
+    """Returns the cached document, if any and no older than max_age."""
+    path = _cache_path(api, version)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if max_age is not None and age > max_age:
+            return None
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+    except (IOError, OSError):
+        return None
+
+
+def _write_cache(api, version, content):
+    path = _cache_path(api, version)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        if not os.path.isdir(DISCOVERY_CACHE_DIR):
+            os.makedirs(DISCOVERY_CACHE_DIR)
+        with open(tmp_path, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # The cache only saves time; the document is still used as fetched.
+        pass
+
+
+def _fetch(api, version):
+    """Fetches the discovery document over the network, or returns None."""
+    http = httplib2.Http(timeout=10)
+    for url in _DISCOVERY_URLS:
+        try:
+            response, content = http.request(url.format(api=api,
+                                                        version=version))
+        except (httplib2.HttpLib2Error, IOError, OSError):
+            continue
+        if response.status == 200:
+            return content.decode('utf-8')
+    return None
+
+
+def _load_document(api, version):
+    """Finds the discovery document, going to the network only if needed.
+
+    A cached document younger than DISCOVERY_MAX_AGE_S is used as is.
+    Otherwise the document is fetched and cached again. If that fails, the
+    cached document is used whatever its age, and failing that the one
+    bundled with googleapiclient.
+    """
+    content = _read_cache(api, version, DISCOVERY_MAX_AGE_S)
+    if content is None:
+        content = _fetch(api, version)
+        if content is not None:
+            _write_cache(api, version, content)
+    if content is None:
+        content = _read_cache(api, version, None)
+    if content is None and get_static_doc is not None:
+        content = get_static_doc(api, version)
+    if content is None:
+        raise RuntimeError('No discovery document found for {} {}.'.format(
+            api, version))
+    return json.loads(content)
+
+
+def _scopes(document):
+    return sorted(document.get('auth', {}).get('oauth2', {}).get('scopes', {}))
+
+
+def build_service(api, version):
+    """Returns the client for the given API, built once per process.
+
+    Building a client from its discovery document takes a while, so the
+    client is kept and returned again by later calls. It is safe to use
+    from several threads at once, as its requests are sent over a pool of
+    connections; see impl/client/transport.py.
+    """
+    key = (api, version)
+    with _lock:
+        service = _services.get(key)
+        if service is None:
+            document = _load_document(api, version)
+            service = build_from_document(
+                document, http=pooled_http(_scopes(document)))
+            _services[key] = service
+        return service
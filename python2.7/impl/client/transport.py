@@ -0,0 +1,111 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+import google.auth
+import google_auth_httplib2
+from googleapiclient.http import build_http
+
+# Maximum number of connections each API client keeps open at once.
+API_HTTP_POOL_SIZE = int(
+    os.environ.get('PROCUREMENT_CODELAB_API_HTTP_POOL_SIZE', 10))
+
+# Seconds after which an idle connection is closed rather than reused, as
+# the server may have dropped it by then.
+_MAX_IDLE_S = 60
+
+
+def _close_connections(http):
+    connections = http.http.connections
+    for connection in list(connections.values()):
+        try:
+            connection.close()
+        except Exception:
+            pass
+    connections.clear()
+
+
+class PooledHttp(object):
+    """A thread-safe stand-in for httplib2.Http, backed by a pool of them.
+
+    An httplib2.Http must not be used by two threads at once. Each request
+    borrows an authorized Http from the pool for its duration, creating one
+    if none is idle and fewer than `size` exist, and waiting otherwise.
+    Connections are kept alive between requests. One that failed, or was
+    idle for too long, is closed before the Http is used again, so the next
+    request reconnects.
+
+    Pass it as the http of a client built with build_from_document(), so
+    that every request of the client goes through the pool.
+    """
+
+    def __init__(self, credentials, size=API_HTTP_POOL_SIZE):
+        # Read by googleapiclient, to authorize each request of a batch.
+        self.credentials = credentials
+        self._size = size
+        self._cond = threading.Condition()
+        # Idle (Http, time released) pairs, the most recently used last.
+        self._idle = []
+        self._created = 0
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._created >= self._size:
+                self._cond.wait()
+            if self._idle:
+                http, released = self._idle.pop()
+                if time.time() - released > _MAX_IDLE_S:
+                    _close_connections(http)
+                return http
+            self._created += 1
+        try:
+            return google_auth_httplib2.AuthorizedHttp(self.credentials,
+                                                       http=build_http())
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, http):
+        with self._cond:
+            self._idle.append((http, time.time()))
+            self._cond.notify()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        """Sends a request like httplib2.Http.request(), on a pooled Http."""
+        http = self._acquire()
+        try:
+            return http.request(uri, method=method, body=body,
+                                headers=headers, **kwargs)
+        except Exception:
+            _close_connections(http)
+            raise
+        finally:
+            self._release(http)
+
+    def close(self):
+        """Closes the connections of every idle Http."""
+        with self._cond:
+            for http, _ in self._idle:
+                _close_connections(http)
+
+
+def pooled_http(scopes, size=API_HTTP_POOL_SIZE):
+    """Returns a PooledHttp authorized with the application's credentials."""
+    credentials, _ = google.auth.default(scopes=scopes)
+    return PooledHttp(credentials, size)
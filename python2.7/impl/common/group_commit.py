@@ -0,0 +1,109 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+class _Ticket(object):
+    """Lets a writer wait until the batch holding its record was flushed."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._error = None
+
+    def finish(self, error=None):
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+
+
+class GroupCommitter(object):
+    """Flushes records from concurrent writers together in a single batch.
+
+    A batch is flushed once `window` seconds have passed since its first record
+    arrived, or as soon as it holds `max_records` records. Writers block in
+    `submit` until the batch containing their record has been flushed, so a
+    Pub/Sub message is still only acked after its change is persisted, or its
+    API request answered.
+    """
+
+    def __init__(self, flush, window, max_records, idle=None,
+                 idle_interval=None):
+        self._flush = flush
+        self._window = window
+        self._max_records = max_records
+        self._idle = idle
+        self._idle_interval = idle_interval
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def enqueue(self, record):
+        """Queues a record without waiting; returns a ticket to wait on.
+
+        Callers that need records for the same key to be flushed in the order
+        they were applied should enqueue while holding their own lock, and then
+        wait on the ticket after releasing it.
+        """
+        ticket = _Ticket()
+        with self._cond:
+            self._pending.append((record, ticket))
+            self._cond.notify()
+        return ticket
+
+    def depth(self):
+        """Returns the number of records waiting to be flushed."""
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, record):
+        """Queues a record and blocks until it has been flushed."""
+        self.enqueue(record).wait()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait(self._idle_interval)
+                if not self._pending and self._idle:
+                    return []
+            deadline = time.time() + self._window
+            while len(self._pending) < self._max_records:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self._max_records]
+            del self._pending[:self._max_records]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                self._idle()
+                continue
+            error = None
+            try:
+                self._flush([record for record, _ in batch])
+            except Exception as e:
+                error = e
+            for _, ticket in batch:
+                ticket.finish(error)
@@ -0,0 +1,140 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc; the memory benchmark is not available.
+    tracemalloc = None
+
+from impl.database import journal
+from impl.database import records
+from impl.database.serialization import get_codec
+from impl.database.shard import FORMAT_DOCUMENT, FORMAT_RECORDS, Shard
+
+DEFAULT_COUNTS = [10000, 100000, 1000000]
+CODECS = ['json', 'orjson', 'msgpack']
+
+
+def _customers(count):
+    """Generates customers shaped like the ones the codelab stores."""
+    customers = {}
+    for i in range(count):
+        account_id = 'account-{:08d}'.format(i)
+        customers[account_id] = {
+            'procurement_account_id': account_id,
+            'internal_account_id': 'internal-{:08d}'.format(i),
+            'products': {
+                'codelab-product': {
+                    'product_id': 'codelab-product',
+                    'plan_id': 'plan-{}'.format(i % 3),
+                    'start_time': '2018-10-01T12:34:56Z',
+                    'consumer_id': 'project_number:{:012d}'.format(i),
+                },
+            },
+        }
+    return customers
+
+
+def _timed(fn):
+    start = time.time()
+    fn()
+    return time.time() - start
+
+
+def _benchmark(directory, customers, file_format, codec):
+    policy = journal.SyncPolicy(journal.DURABILITY_OS)
+    path = os.path.join(directory, 'database')
+
+    shard = Shard(path, policy, False, file_format, codec)
+    shard.records = customers
+    commit = _timed(shard.commit)
+
+    shard = Shard(path, policy, False, file_format, codec)
+    load = _timed(shard.load)
+    decode = _timed(lambda: sum(1 for _ in shard.items()))
+    return commit, load, decode, os.path.getsize(path)
+
+
+def _memory(build):
+    """Returns the number of bytes allocated by build() and still held."""
+    tracemalloc.start()
+    try:
+        held = build()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del held
+    return size
+
+
+def _benchmark_memory(counts):
+    """Compares the memory held by customers as dictionaries and compacted."""
+    print('{:>9} {:>14} {:>14} {:>7}'.format('customers', 'dict bytes',
+                                            'compact bytes', 'ratio'))
+    for count in counts:
+        as_dicts = _memory(lambda: _customers(count))
+        compacted = _memory(lambda: dict(
+            (key, records.compact(value))
+            for key, value in _customers(count).items()))
+        print('{:>9} {:>14} {:>14} {:>7.2f}'.format(
+            count, as_dicts, compacted, float(compacted) / as_dicts))
+
+
+def main(argv):
+    """Times committing and loading the database for each format and codec.
+
+    With 'memory' as the first argument, compares the memory held by the
+    records in memory instead.
+    """
+
+    if argv[1:2] == ['memory']:
+        if tracemalloc is None:
+            print('The memory benchmark requires Python 3.')
+            return
+        _benchmark_memory([int(count) for count in argv[2:]] or DEFAULT_COUNTS)
+        return
+
+    counts = [int(count) for count in argv[1:]] or DEFAULT_COUNTS
+
+    print('{:>9} {:>8} {:>8} {:>9} {:>9} {:>9} {:>12}'.format(
+        'customers', 'format', 'codec', 'commit s', 'load s', 'decode s',
+        'bytes'))
+    directory = tempfile.mkdtemp()
+    try:
+        for count in counts:
+            customers = _customers(count)
+            for file_format in (FORMAT_DOCUMENT, FORMAT_RECORDS):
+                for name in CODECS:
+                    try:
+                        codec = get_codec(name)
+                    except ImportError:
+                        continue
+                    commit, load, decode, size = _benchmark(
+                        directory, customers, file_format, codec)
+                    print('{:>9} {:>8} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} '
+                          '{:>12}'.format(count, file_format, name, commit,
+                                          load, decode, size))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,140 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+
+from impl.database import file_lock
+from impl.database import journal
+from impl.database import records
+
+# A change to the record with the given key, which went from old to new. old
+# is None for a record that was created and new is None for one that was
+# deleted. Sequence numbers start at 1 and increase by 1 with every change.
+Change = collections.namedtuple('Change', ['seq', 'key', 'old', 'new'])
+
+
+class ChangesExpired(Exception):
+    """Raised when the changes after a sequence number were discarded.
+
+    The reader has to start over from the current state of the database.
+    """
+
+
+class ChangeCursor(object):
+    """Reads the changes made to a database, resuming after a sequence number.
+
+    The cursor's seq is the sequence number of the last change read. Saving it
+    and passing it to database.changes() later resumes where it stopped.
+    """
+
+    def __init__(self, database, seq=0):
+        self.database = database
+        self.seq = seq
+
+    def poll(self, limit=None):
+        """Returns the changes made since the last poll, oldest first."""
+        changes = self.database.read_changes(self.seq, limit)
+        if changes:
+            self.seq = changes[-1].seq
+        return changes
+
+
+class ChangeFeed(object):
+    """Ordered log of the changes made to the JSON database.
+
+    Changes are appended to a journal next to the database, so they survive
+    restarts, and the most recent ones are also kept in memory to serve
+    readers. Only the last `retention` changes are guaranteed to be kept.
+    The log is appended to apart from the database files, so a crash can
+    leave it missing a persisted change, or holding one that was never
+    persisted; see JsonDatabase.
+
+    A shared feed may be written by several processes, under an exclusive lock
+    on its lock file. Each process catches up with the changes the others
+    appended before numbering its own or serving readers.
+    """
+
+    def __init__(self, path, policy, codec, retention, shared=False):
+        if retention < 1:
+            raise ValueError('The change feed must retain at least 1 change.')
+        self.retention = retention
+        self._log = journal.Journal(path, policy, codec)
+        self._changes = []
+        self._lock = threading.Lock()
+        self.file_lock = None
+        if shared:
+            self.file_lock = file_lock.FileLock(path + '.lock')
+        with file_lock.exclusive(self.file_lock):
+            self._changes = [_from_record(r) for r in self._log.read_all()]
+            # As with a shard's journal, a feed written with a different
+            # encoding is rewritten straight away, so that it never mixes
+            # encodings.
+            if self._log.encoding not in (None, self._log.codec.encoding):
+                self._log.rewrite([_to_record(c) for c in self._changes])
+
+    def _catch_up(self):
+        if self.file_lock is None or not self._log.changed():
+            return
+        tail = self._log.read_tail()
+        if tail is None:
+            self._changes = [_from_record(r) for r in self._log.read_all()]
+        else:
+            self._changes.extend(_from_record(r) for r in tail)
+
+    def _last_seq(self):
+        return self._changes[-1].seq if self._changes else 0
+
+    def publish(self, key, old, new):
+        """Appends a change made to the database, returning its number."""
+        with file_lock.exclusive(self.file_lock), self._lock:
+            self._catch_up()
+            change = Change(self._last_seq() + 1, key, old, new)
+            self._log.append([_to_record(change)])
+            self._changes.append(change)
+            if len(self._changes) >= 2 * self.retention:
+                self._changes = self._changes[-self.retention:]
+                self._log.rewrite([_to_record(c) for c in self._changes])
+        return change.seq
+
+    def read(self, seq, limit=None):
+        """Returns the changes made after the one numbered seq, oldest first.
+
+        Raises ChangesExpired if some of them were already discarded.
+        """
+        with file_lock.shared(self.file_lock), self._lock:
+            self._catch_up()
+            first = self._changes[0].seq if self._changes else 1
+            if seq < first - 1:
+                raise ChangesExpired(
+                    'Changes after {} were discarded; the oldest kept is {}.'
+                    .format(seq, first))
+            start = max(seq - first + 1, 0)
+            end = None if limit is None else start + limit
+            changes = self._changes[start:end]
+        return [
+            Change(c.seq, c.key, records.expand(c.old), records.expand(c.new))
+            for c in changes
+        ]
+
+
+def _to_record(change):
+    return {'seq': change.seq, 'key': change.key, 'old': change.old,
+            'new': change.new}
+
+
+def _from_record(record):
+    return Change(record['seq'], record['key'],
+                  records.compact(record['old']),
+                  records.compact(record['new']))
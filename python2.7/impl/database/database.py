@@ -12,40 +12,653 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import collections
+import contextlib
+import heapq
+import itertools
 import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+
+from impl.common.group_commit import GroupCommitter
+from impl.common.metrics import InMemoryMetrics, timed
+from impl.database import file_lock
+from impl.database.change_feed import ChangeCursor, ChangeFeed
+from impl.database import journal
+from impl.database import records
+from impl.database.index import CustomerIndexes, IndexQueries
+from impl.database.serialization import get_codec
+from impl.database.shard import (FORMAT_DOCUMENT, Shard, shard_index,
+                                 shard_path)
+from impl.database.snapshot import Snapshot
+from impl.database.versions import VersionedRecords
 
 DATABASE_FILE = os.environ['PROCUREMENT_CODELAB_DATABASE']
 
+# Storage backend used by open_database(): 'json', 'sqlite', 'tiered' or
+# 'redis'.
+DATABASE_BACKEND = os.environ.get('PROCUREMENT_CODELAB_DATABASE_BACKEND', 'json')
+
+# Set to 1 to append each change to a journal instead of rewriting the file.
+JOURNAL_ENABLED = os.environ.get('PROCUREMENT_CODELAB_DATABASE_JOURNAL') == '1'
+
+# Number of journal records after which the journal is folded into the file.
+JOURNAL_COMPACTION_THRESHOLD = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_COMPACTION_THRESHOLD', 10000))
+
+# Format the database file is written in: 'document' for a single object, or
+# 'records' for a record file that is loaded lazily. Existing files are read in
+# whichever format they are in.
+DATABASE_FORMAT = os.environ.get('PROCUREMENT_CODELAB_DATABASE_FORMAT',
+                                 FORMAT_DOCUMENT)
+
+# Codec records are written with: 'json', 'orjson' or 'msgpack'. Existing
+# files are read according to the encoding named in their header.
+DATABASE_CODEC = os.environ.get('PROCUREMENT_CODELAB_DATABASE_CODEC', 'json')
+
+# Number of files the records are partitioned across, by account ID hash.
+SHARD_COUNT = int(os.environ.get('PROCUREMENT_CODELAB_DATABASE_SHARDS', 1))
+
+# Set to 1 when several processes use the database at once, such as the
+# listener and the usage reporting script.
+SHARED = os.environ.get('PROCUREMENT_CODELAB_DATABASE_SHARED') == '1'
+
+# Set to 1 to log every change to <database>.changes, to be read back in order
+# with changes().
+CHANGE_FEED_ENABLED = (
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_CHANGE_FEED') == '1')
+
+# Number of changes the change feed keeps, at least.
+CHANGE_FEED_RETENTION = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_CHANGE_FEED_RETENTION',
+                   10000))
+
+# Number of locks that records are spread across. Changes to records guarded by
+# different locks proceed in parallel.
+LOCK_STRIPES = 64
+
+# When greater than 0, changes arriving within this many milliseconds of each
+# other are flushed together by a background thread.
+GROUP_COMMIT_WINDOW_MS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_GROUP_COMMIT_WINDOW_MS', 0))
+
+# Maximum number of changes flushed together in one group commit.
+GROUP_COMMIT_MAX_RECORDS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_GROUP_COMMIT_MAX_RECORDS', 100))
+
+# One of 'always', 'interval' or 'os'. See impl/database/journal.py.
+DURABILITY = os.environ.get('PROCUREMENT_CODELAB_DATABASE_DURABILITY',
+                            journal.DURABILITY_ALWAYS)
+
+# How often writes are synced to disk with the 'interval' durability policy.
+SYNC_INTERVAL_MS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_SYNC_INTERVAL_MS', 1000))
+
+
+# Appended to the files of a previous shard count once their records were
+# moved to the current one, so that they are never read again.
+RESHARDED_SUFFIX = '.resharded'
+
+# Matches what shard_path() appends to the database path.
+_SHARD_SUFFIX = re.compile(r'^\.(\d+)-of-(\d+)$')
+
+# Marks a record deleted by a transaction.
+_DELETED = object()
+
+
+def _shard_counts(path):
+    """Returns the shard counts of the shard files found next to path."""
+    directory, name = os.path.split(os.path.abspath(path))
+    counts = set()
+    for entry in os.listdir(directory):
+        if entry.startswith(name):
+            match = _SHARD_SUFFIX.match(entry[len(name):])
+            if match and int(match.group(2)) > 1:
+                counts.add(int(match.group(2)))
+    return counts
+
+
+def _retire(path):
+    """Renames a file and its journal, if they exist, so they are not read."""
+    for name in (path, path + '.journal'):
+        if os.path.exists(name):
+            os.rename(name, name + RESHARDED_SUFFIX)
+
 
-class JsonDatabase(object):
-    """JSON-based implementation of a simple file-based database."""
+class _Transaction(object):
+    """The changes staged by a transaction, and the locks it holds."""
 
     def __init__(self):
-        self.database = json.loads(open(DATABASE_FILE, 'r').read())
+        # Maps keys to their new record, or _DELETED, in the order changed.
+        self.staged = collections.OrderedDict()
+        self._held = []
+
+    @property
+    def locked(self):
+        return bool(self._held)
+
+    def hold(self, lock):
+        lock.__enter__()
+        self._held.append(lock)
+
+    def release(self):
+        while self._held:
+            self._held.pop().__exit__(None, None, None)
+
+
+class JsonDatabase(IndexQueries, VersionedRecords):
+    """JSON-based implementation of a simple file-based database.
+
+    Records can be partitioned across several shard files by a hash of their
+    key, in which case a change only rewrites the shard holding its record.
+
+    The database is safe to use from several threads. Changes to a record are
+    serialized by a lock striped by key, and records are copied on the way in
+    and out, so a caller mutating a record never races a commit serializing it.
+    In memory, customer records are held in the compact form of
+    impl/database/records.py rather than as dictionaries.
+
+    Secondary indexes on consumer ID, internal account ID, product and plan are
+    rebuilt on load and kept up to date by every write and delete.
+
+    A shared database may be used by several processes at once. Every change
+    is then made under an exclusive lock on the shard's lock file, after
+    catching up with the changes other processes made to the shard, and is
+    persisted before the lock is released. Reads check whether the shard file
+    or journal changed, and if so catch up first: records appended to the
+    journal are applied one by one, while a rewritten shard file is loaded
+    again. Use the journal, so that catching up is incremental.
+
+    Several writes and deletes can be committed together with transaction(),
+    and a record can be written only if it did not change since it was read
+    with write_if_version(); see impl/database/versions.py.
+
+    A write that would not change its record, such as one made again for a
+    redelivered message, is skipped without any I/O. The writes_skipped and
+    changes_committed counters tell how many changes were skipped and made.
+
+    The database measures itself into its metrics sink, an InMemoryMetrics
+    unless another MetricsSink is passed in: the latency of each read, write,
+    delete, update, flush, commit and load, the bytes written, and as gauges,
+    the number of records, the size of the files and the number of changes
+    waiting for a group commit.
+
+    With the change feed enabled, every write and delete is also logged, in
+    order, to a ChangeFeed that readers can follow with changes(). A change is
+    logged once it is persisted, or with group commit, once it is queued.
+    The feed is a separate file, so it is best-effort across crashes: a crash
+    right after a change was persisted can leave the change out of the feed,
+    and with group commit, a crash before a queued change is flushed leaves
+    the feed holding a change the database lost. Readers that must not miss a
+    change should use the SQLite backend, which logs changes in the same
+    transaction, or reconcile with the records after a crash.
+    """
+
+    def __init__(self, use_journal=JOURNAL_ENABLED,
+                 compaction_threshold=JOURNAL_COMPACTION_THRESHOLD,
+                 group_commit_window_ms=GROUP_COMMIT_WINDOW_MS,
+                 group_commit_max_records=GROUP_COMMIT_MAX_RECORDS,
+                 durability=DURABILITY, sync_interval_ms=SYNC_INTERVAL_MS,
+                 shard_count=SHARD_COUNT, file_format=DATABASE_FORMAT,
+                 codec=DATABASE_CODEC, shared=SHARED,
+                 change_feed=CHANGE_FEED_ENABLED,
+                 change_feed_retention=CHANGE_FEED_RETENTION, metrics=None):
+        if shared and group_commit_window_ms > 0:
+            raise ValueError('Group commit cannot be used with a shared '
+                             'database.')
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
+        self.policy = journal.SyncPolicy(durability, sync_interval_ms / 1000.0)
+        self.compaction_threshold = compaction_threshold
+        self.codec = get_codec(codec)
+        self.shards = [
+            Shard(shard_path(DATABASE_FILE, i, shard_count), self.policy,
+                  use_journal, file_format, self.codec, shared)
+            for i in range(shard_count)
+        ]
+        self._indexes = CustomerIndexes(self._items)
+        with self.metrics.timer('load'):
+            self._load(file_format)
+
+        self.change_feed = None
+        if change_feed:
+            self.change_feed = ChangeFeed(DATABASE_FILE + '.changes',
+                                          self.policy, self.codec,
+                                          change_feed_retention, shared)
+
+        self._key_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self.writes_skipped = 0
+        self.changes_committed = 0
+        self._counters_lock = threading.Lock()
+        # Holds the transaction open on each thread, if any.
+        self._local = threading.local()
+        self._committer = None
+        if group_commit_window_ms > 0:
+            self._committer = GroupCommitter(
+                self._flush, group_commit_window_ms / 1000.0,
+                group_commit_max_records, idle=self.policy.sync_pending,
+                idle_interval=self.policy.interval)
+        self._report_sizes()
+
+    def _load(self, file_format):
+        """Loads all shards in parallel, resharding the records first if needed."""
+        # The first shard's lock file guards resharding.
+        with file_lock.exclusive(self.shards[0].file_lock):
+            if self._reshard(file_format):
+                return
+        if len(self.shards) == 1:
+            self._load_shard(self.shards[0])
+            return
+
+        pool = ThreadPool(len(self.shards))
+        try:
+            pool.map(self._load_shard, self.shards)
+        finally:
+            pool.close()
+
+    def _load_shard(self, shard):
+        with file_lock.exclusive(shard.file_lock):
+            shard.load()
+
+    def _reshard(self, file_format):
+        """Moves the records stored with another shard count into the shards.
+
+        The unsharded file counts as one shard. Once the shards are written,
+        the files the records came from are renamed with RESHARDED_SUFFIX, so
+        that stale copies of the records are never read back. Returns whether
+        the records were moved, in which case the shards are loaded.
+        """
+        shard_count = len(self.shards)
+        others = sorted(_shard_counts(DATABASE_FILE) - set([shard_count]))
+        if shard_count > 1 and os.path.exists(DATABASE_FILE):
+            others.insert(0, 1)
+        if all(os.path.exists(shard.path) for shard in self.shards):
+            if others == [1]:
+                # Left behind by a split made before unsharded files were
+                # renamed, and stale ever since.
+                _retire(DATABASE_FILE)
+            elif others:
+                raise ValueError(
+                    'Found database files for {} shard(s) besides the {} '
+                    'configured; remove the stale ones.'.format(
+                        ' and '.join(str(count) for count in others),
+                        shard_count))
+            return False
+        if not others:
+            return False
+        if len(others) > 1:
+            raise ValueError(
+                'Found database files for {} shards; remove the stale ones '
+                'before changing the shard count to {}.'.format(
+                    ' and '.join(str(count) for count in others), shard_count))
+
+        # A shard file missing means the records were never moved, or moving
+        # them was interrupted, so they are moved again from the old files.
+        paths = [shard_path(DATABASE_FILE, i, others[0])
+                 for i in range(others[0])]
+        for path in paths:
+            old = Shard(path, self.policy, os.path.exists(path + '.journal'),
+                        file_format, self.codec).load()
+            for key, value in old.items():
+                self._shard(key).records[key] = value
+            if old.journal is not None:
+                old.journal.close()
+        for shard in self.shards:
+            shard.commit()
+        for path in paths:
+            _retire(path)
+        return True
 
+    @contextlib.contextmanager
+    def _exclusive(self, shard):
+        """Holds the shard's file lock, after catching up with the shard."""
+        with file_lock.exclusive(shard.file_lock):
+            self._catch_up(shard)
+            yield
+
+    def _refresh(self, shard):
+        """Catches up with the changes other processes made to the shard."""
+        if shard.file_lock is not None and shard.changed():
+            with file_lock.shared(shard.file_lock):
+                self._catch_up(shard)
+
+    def _catch_up(self, shard):
+        if shard.file_lock is None or not shard.changed():
+            return
+        changes = shard.refresh()
+        if changes is None:
+            self._indexes.reset()
+            return
+        for key, old, new in changes:
+            self._indexes.update(key, old, new)
+
+    def _shard(self, key):
+        return self.shards[shard_index(key, len(self.shards))]
+
+    def _key_lock(self, key):
+        return self._key_locks[shard_index(key, LOCK_STRIPES)]
+
+    @timed('read')
     def read(self, key):
         """Read the record with the given key from the database, if it exists."""
-        if key in self.database:
-            return self.database[key]
-        return None
+        transaction = self._transaction()
+        if transaction is not None and key in transaction.staged:
+            value = transaction.staged[key]
+            return None if value is _DELETED else records.expand(value)
+        shard = self._shard(key)
+        self._refresh(shard)
+        return records.expand(shard.get(key))
 
+    @timed('write')
     def write(self, key, value):
         """Write the record with the given key to the database."""
-        self.database[key] = value
-        self.commit()
+        value = records.compact(value)
+        if self._stage(key, value):
+            return
+        shard = self._shard(key)
+        with self._key_lock(key), self._exclusive(shard):
+            if self._unchanged(shard, key, value):
+                self._count(skipped=1)
+                return
+            old = shard.set(key, value)
+            self._count(committed=1)
+            self._indexes.update(key, old, value)
+            ticket = self._persist(journal.write_record(key, value))
+            self._publish(key, old, value)
+        self._wait(ticket)
 
+    @timed('delete')
     def delete(self, key):
         """Delete the record with the given key from the database, if it exists."""
-        if key in self.database:
-            del self.database[key]
-            self.commit()
+        if self._stage(key, _DELETED):
+            return
+        shard = self._shard(key)
+        with self._key_lock(key), self._exclusive(shard):
+            with shard.lock:
+                if key not in shard.records:
+                    return
+                old = shard.pop(key)
+            self._count(committed=1)
+            self._indexes.update(key, old, None)
+            ticket = self._persist(journal.delete_record(key))
+            self._publish(key, old, None)
+        self._wait(ticket)
+
+    @timed('update')
+    def update(self, key, fn):
+        """Atomically replaces the record with the given key with fn(record).
+
+        fn receives a copy of the current record, or None if it does not exist,
+        and returns the record to write. If it returns None, the record is left
+        unchanged. No other change to the record can happen in between.
+        """
+        transaction = self._transaction()
+        if transaction is not None:
+            self._lock_transaction(transaction)
+        with self._key_lock(key), self._exclusive(self._shard(key)):
+            value = fn(self.read(key))
+            if value is not None:
+                self.write(key, value)
+            return value
+
+    def _unchanged(self, shard, key, value):
+        with shard.lock:
+            return key in shard.records and records.same(shard.records[key],
+                                                         value)
+
+    def _count(self, skipped=0, committed=0):
+        with self._counters_lock:
+            self.writes_skipped += skipped
+            self.changes_committed += committed
+        if skipped:
+            self.metrics.increment('writes_skipped', skipped)
+        if committed:
+            self.metrics.increment('changes_committed', committed)
+
+    def _transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits the writes and deletes made within on this thread together.
+
+        Changes are staged until the block ends, and reads on this thread see
+        them. They are then applied at once, so no snapshot sees only some of
+        them, and persisted with one journal record or file rewrite per shard
+        touched, which is replayed either in full or not at all. If the block
+        raises an exception, nothing is changed.
+
+        A transaction is only atomic across crashes within one shard: the
+        shards it touches are persisted one after the other, so a crash in
+        between leaves it applied to some shards and not to the others. With
+        several shards, keep changes that must survive a crash together to
+        the same account ID, or to a single-shard database.
+
+        From its first change until it ends, a transaction is the only writer:
+        it holds every key lock, and in a shared database every shard's file
+        lock. A transaction started within another joins it.
+        """
+        if self._transaction() is not None:
+            yield
+            return
+
+        transaction = self._local.transaction = _Transaction()
+        try:
+            yield
+            tickets = self._commit_transaction(transaction)
+        finally:
+            self._local.transaction = None
+            transaction.release()
+        for ticket in tickets:
+            self._wait(ticket)
+
+    def _lock_transaction(self, transaction):
+        """Takes the locks a transaction holds once it changes something.
+
+        They are taken in a fixed order, before any other, so that two
+        transactions never wait on each other.
+        """
+        if not transaction.locked:
+            for lock in self._key_locks:
+                transaction.hold(lock)
+            for shard in self.shards:
+                transaction.hold(self._exclusive(shard))
+
+    def _stage(self, key, value):
+        """Stages a change in the current transaction, if there is one."""
+        transaction = self._transaction()
+        if transaction is None:
+            return False
+        self._lock_transaction(transaction)
+        transaction.staged[key] = value
+        return True
+
+    def _commit_transaction(self, transaction):
+        """Applies and persists the changes of a transaction.
+
+        Returns the tickets to wait on for them to be persisted.
+        """
+        by_shard = collections.OrderedDict()
+        for key, value in transaction.staged.items():
+            by_shard.setdefault(self._shard(key), []).append((key, value))
+
+        changes = []
+        batches = []
+        skipped = 0
+        shards = sorted(by_shard, key=self.shards.index)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            for shard in shards:
+                batch = []
+                for key, value in by_shard[shard]:
+                    if value is not _DELETED:
+                        if self._unchanged(shard, key, value):
+                            skipped += 1
+                            continue
+                        changes.append((key, shard.set(key, value), value))
+                        batch.append(journal.write_record(key, value))
+                    elif key in shard.records:
+                        changes.append((key, shard.pop(key), None))
+                        batch.append(journal.delete_record(key))
+                if batch:
+                    batches.append(journal.batch_record(batch))
+        finally:
+            for shard in reversed(shards):
+                shard.lock.release()
+
+        self._count(skipped=skipped, committed=len(changes))
+        for key, old, new in changes:
+            self._indexes.update(key, old, new)
+        # Each shard's batch is persisted on its own, so across shards the
+        # transaction is not atomic if the process crashes; see transaction().
+        tickets = [self._persist(batch) for batch in batches]
+        for key, old, new in changes:
+            self._publish(key, old, new)
+        return tickets
+
+    def _index_keys(self, name, value):
+        for shard in self.shards:
+            self._refresh(shard)
+        return self._indexes.keys(name, value)
+
+    def _persist(self, record):
+        """Persists a change now, or queues it when group commit is enabled."""
+        if self._committer is not None:
+            ticket = self._committer.enqueue(record)
+            self.metrics.set_gauge('commit_queue_depth',
+                                   self._committer.depth())
+            return ticket
+        self._flush([record])
+        return None
+
+    def _publish(self, key, old, new):
+        # Appended separately from the shard's journal or file, so not
+        # atomically with the change; see the class docstring.
+        if self.change_feed is not None:
+            self.change_feed.publish(key, old, new)
+
+    def changes(self, since=0):
+        """Returns a ChangeCursor over the changes made after the given one.
+
+        Pass the seq of a cursor saved earlier to resume where it stopped.
+        """
+        if self.change_feed is None:
+            raise ValueError('The change feed is not enabled.')
+        return ChangeCursor(self, since)
+
+    def read_changes(self, seq, limit=None):
+        """Returns up to limit changes made after the one numbered seq."""
+        return self.change_feed.read(seq, limit)
+
+    def _wait(self, ticket):
+        if ticket is not None:
+            ticket.wait()
+
+    @timed('flush')
+    def _flush(self, records):
+        """Persists changes to the journal or file of each shard they touch."""
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(self._shard(journal.record_key(record)),
+                                []).append(record)
+
+        written = 0
+        for shard, shard_records in by_shard.items():
+            if shard.journal is not None:
+                written += shard.journal.append(shard_records)
+                if shard.journal.records < self.compaction_threshold:
+                    continue
+            written += shard.commit()
+        self.metrics.increment('bytes_written', written)
+        self._report_sizes()
+
+    def _report_sizes(self):
+        self.metrics.set_gauge('records', sum(len(shard.records)
+                                              for shard in self.shards))
+        self.metrics.set_gauge('file_bytes', sum(shard.disk_size()
+                                                 for shard in self.shards))
+        if self._committer is not None:
+            self.metrics.set_gauge('commit_queue_depth',
+                                   self._committer.depth())
 
     def commit(self):
-        """Commits changes to the database by writing the in-memory dictionary."""
-        with open(DATABASE_FILE, 'w') as f:
-            json.dump(self.database, f)
+        """Commits changes to the database by writing the in-memory dictionary.
+
+        In journal mode this is the compaction step: each shard file is
+        rewritten and the journal records it now contains are discarded.
+        """
+        written = 0
+        with self.metrics.timer('commit'):
+            for shard in self.shards:
+                with self._exclusive(shard):
+                    written += shard.commit()
+        self.metrics.increment('bytes_written', written)
+        self._report_sizes()
 
     def items(self):
-        """Provides a way to iterate over all elements in the database."""
-        return self.database.items()
+        """Provides a way to iterate over all elements in the database.
+
+        Shards are visited one after another, and each shard's records are
+        listed when it is reached, so records may be written while iterating.
+        Use snapshot() for a consistent view.
+        """
+        return ((key, records.expand(value))
+                for key, value in itertools.chain.from_iterable(
+                    self._refreshed_items(shard) for shard in self.shards))
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order, as (key, record) pairs.
+
+        The scan starts at start_key, or just after it if inclusive is False,
+        and only covers keys starting with prefix. To page through the
+        database, pass the last key of each page back as start_key, with
+        inclusive False; a job can resume from the last key it processed the
+        same way.
+        """
+        pages = []
+        for shard in self.shards:
+            self._refresh(shard)
+            pages.append(shard.scan(start_key, limit, prefix, inclusive))
+        return [(key, records.expand(value)) for key, value in
+                itertools.islice(heapq.merge(*pages), limit)]
+
+    def _refreshed_items(self, shard):
+        self._refresh(shard)
+        return shard.items()
+
+    def snapshot(self):
+        """Returns a consistent Snapshot of the whole database as of now.
+
+        Every shard is locked while the snapshot is taken, so no change can
+        land in some shards' view but not in others'.
+        """
+        for shard in self.shards:
+            self._refresh(shard)
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            return Snapshot([shard.snapshot() for shard in self.shards])
+        finally:
+            for shard in reversed(self.shards):
+                shard.lock.release()
+
+    def _items(self):
+        return itertools.chain.from_iterable(
+            shard.items() for shard in self.shards)
+
+
+def open_database(backend=DATABASE_BACKEND):
+    """Opens the database using the configured storage backend."""
+    if backend == 'json':
+        return JsonDatabase()
+    if backend == 'sqlite':
+        from impl.database.sqlite_database import SqliteDatabase
+        return SqliteDatabase()
+    if backend == 'tiered':
+        from impl.database.tiered_database import TieredDatabase
+        return TieredDatabase()
+    if backend == 'redis':
+        from impl.database.redis_database import RedisDatabase
+        return RedisDatabase()
+    raise ValueError('Unknown database backend: {}'.format(backend))
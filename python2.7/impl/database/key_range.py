@@ -0,0 +1,60 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import sys
+
+# Every backend orders keys by code point, as Python compares strings and as
+# SQLite and Redis compare their UTF-8 encoding.
+_MAX_CODE_POINT = sys.maxunicode
+
+
+def prefix_end(prefix):
+    """Returns the first key after every key starting with prefix, or None."""
+    while prefix and ord(prefix[-1]) == _MAX_CODE_POINT:
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + _chr(ord(prefix[-1]) + 1)
+
+
+def _chr(code_point):
+    try:
+        return unichr(code_point)
+    except NameError:
+        return chr(code_point)
+
+
+def lower_bound(start_key, prefix, inclusive):
+    """Returns the first key a scan covers, and whether it is included."""
+    if start_key is None or start_key < prefix:
+        return prefix, True
+    return start_key, inclusive
+
+
+def select(sorted_keys, start_key=None, limit=None, prefix='',
+           inclusive=True):
+    """Returns the keys a scan covers, out of a sorted list of keys."""
+    first, inclusive = lower_bound(start_key, prefix, inclusive)
+    if inclusive:
+        start = bisect.bisect_left(sorted_keys, first)
+    else:
+        start = bisect.bisect_right(sorted_keys, first)
+    end = len(sorted_keys)
+    last = prefix_end(prefix)
+    if last is not None:
+        end = bisect.bisect_left(sorted_keys, last, start)
+    if limit is not None:
+        end = min(end, start + limit)
+    return sorted_keys[start:end]
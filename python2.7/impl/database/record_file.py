@@ -0,0 +1,271 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import itertools
+import mmap
+import struct
+import zlib
+
+from impl.database import serialization
+
+# Record files store one framed record per customer, so that they can be loaded
+# lazily: opening one only maps it into memory, and a record is only decoded
+# once it is read.
+#
+# A record file starts with a header naming the layout and encoding (see
+# impl/database/serialization.py), followed by one frame per record: the length
+# of the key, the length of the value, a CRC32 of both, the UTF-8 key and the
+# encoded value. The frames are followed by an index of their offsets, sorted
+# by key, and a trailer holding the offset of the index and the number of
+# records, so that a key is found by bisecting the index without reading the
+# other keys. Record files written before the index was added have the LAYOUT
+# layout instead of INDEXED_LAYOUT, and their frames are scanned when opened.
+LAYOUT = 'records'
+INDEXED_LAYOUT = 'indexed-records'
+LAYOUTS = (LAYOUT, INDEXED_LAYOUT)
+
+_FRAME_HEADER = struct.Struct('>III')
+_INDEX_ENTRY = struct.Struct('>Q')
+_TRAILER = struct.Struct('>QQ')
+
+
+def _crc32(key, value):
+    return zlib.crc32(value, zlib.crc32(key)) & 0xffffffff
+
+
+def _encode_frame(key, value, codec):
+    key = key.encode('utf-8')
+    value = codec.dumps(value)
+    return _FRAME_HEADER.pack(len(key), len(value), _crc32(key, value)) + \
+        key + value
+
+
+def dumps(records, codec):
+    """Serializes a dictionary or LazyRecords into a record file.
+
+    Records of a LazyRecords that were never decoded are copied over as they
+    are, without decoding and re-encoding them, if the encoding is unchanged.
+    """
+    header = serialization.make_header(INDEXED_LAYOUT, codec)
+    if isinstance(records, LazyRecords):
+        frames = records.frames(codec)
+    else:
+        frames = [(key, _encode_frame(key, value, codec))
+                  for key, value in records.items()]
+
+    # UTF-8 preserves the order of code points, so keys sort the same way
+    # as the bytes compared when bisecting the index.
+    offsets = {}
+    offset = len(header)
+    for key, frame in frames:
+        offsets[key] = offset
+        offset += len(frame)
+    index = b''.join(_INDEX_ENTRY.pack(offsets[key])
+                     for key in sorted(offsets))
+    return b''.join([header] + [frame for _, frame in frames] +
+                    [index, _TRAILER.pack(offset, len(offsets))])
+
+
+def load(path, codec, transform=None):
+    """Opens the record file at the given path without decoding any records.
+
+    The given codec is used if it reads the encoding named in the header.
+    Decoded records that are kept in memory are passed through transform.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    layout, encoding, header_length = serialization.parse_header(data)
+    codec = serialization.codec_for_encoding(encoding, codec)
+    if layout == LAYOUT:
+        index, index_offset, count = _scan(data, header_length)
+    else:
+        if len(data) < header_length + _TRAILER.size:
+            raise ValueError('Truncated record file')
+        index_offset, count = _TRAILER.unpack_from(
+            data, len(data) - _TRAILER.size)
+        if (index_offset < header_length or index_offset +
+                count * _INDEX_ENTRY.size + _TRAILER.size != len(data)):
+            raise ValueError('Truncated record file')
+        index = data
+    return LazyRecords(data, index, index_offset, count, codec, transform)
+
+
+def _scan(data, offset):
+    """Indexes a record file written without an index by reading every frame.
+
+    Returns the index, its offset and the number of records.
+    """
+    offsets = {}
+    while offset < len(data):
+        key_length, value_length, _ = _FRAME_HEADER.unpack_from(data, offset)
+        start = offset + _FRAME_HEADER.size
+        end = start + key_length + value_length
+        if end > len(data):
+            raise ValueError('Truncated record file')
+        offsets[bytes(data[start:start + key_length])] = offset
+        offset = end
+    index = b''.join(_INDEX_ENTRY.pack(offsets[key])
+                     for key in sorted(offsets))
+    return index, 0, len(offsets)
+
+
+class LazyRecords(MutableMapping):
+    """A dictionary over a memory-mapped record file.
+
+    On creation nothing is read but the trailer: a key is looked up by
+    bisecting the file's index. A record is decoded when it is first looked
+    up and kept from then on. Records written afterwards live in memory until
+    the file is rewritten.
+    """
+
+    def __init__(self, data, index, index_offset, count, codec,
+                 transform=None):
+        self._data = data
+        self._index = index
+        self._index_offset = index_offset
+        self._count = count
+        self._codec = codec
+        self._transform = transform
+        self._decoded = {}
+        # The keys in the file that are decoded, overwritten or deleted, and
+        # so no longer read from it.
+        self._hidden = set()
+
+    def _offset(self, position):
+        return _INDEX_ENTRY.unpack_from(
+            self._index,
+            self._index_offset + position * _INDEX_ENTRY.size)[0]
+
+    def _key(self, offset):
+        key_length = _FRAME_HEADER.unpack_from(self._data, offset)[0]
+        start = offset + _FRAME_HEADER.size
+        return self._data[start:start + key_length]
+
+    def _find(self, key):
+        """Returns the offset of the frame of a key in the file, or None."""
+        key = key.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(self._offset(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            offset = self._offset(low)
+            if self._key(offset) == key:
+                return offset
+        return None
+
+    def _stored(self):
+        """Lists the keys and frame offsets of the records read from the file."""
+        stored = []
+        for position in range(self._count):
+            offset = self._offset(position)
+            key = bytes(self._key(offset)).decode('utf-8')
+            if key not in self._hidden:
+                stored.append((key, offset))
+        return stored
+
+    def _lookup(self, key):
+        if key in self._hidden:
+            raise KeyError(key)
+        offset = self._find(key)
+        if offset is None:
+            raise KeyError(key)
+        value = self._decode(offset)
+        if self._transform is not None:
+            value = self._transform(value)
+        return value
+
+    def _decode(self, offset):
+        key_length, value_length, crc = _FRAME_HEADER.unpack_from(
+            self._data, offset)
+        start = offset + _FRAME_HEADER.size
+        key = self._data[start:start + key_length]
+        value = self._data[start + key_length:
+                           start + key_length + value_length]
+        if _crc32(key, value) != crc:
+            raise ValueError('Corrupt record in record file')
+        return self._codec.loads(value)
+
+    def _frame(self, offset):
+        key_length, value_length, _ = _FRAME_HEADER.unpack_from(
+            self._data, offset)
+        return self._data[offset:offset + _FRAME_HEADER.size + key_length +
+                          value_length]
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+        value = self._lookup(key)
+        self._decoded[key] = value
+        self._hidden.add(key)
+        return value
+
+    def peek(self, key):
+        """Returns a record without keeping it in memory if not yet decoded."""
+        if key in self._decoded:
+            return self._decoded[key]
+        return self._lookup(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._decoded and self._find(key) is not None:
+            self._hidden.add(key)
+        self._decoded[key] = value
+
+    def __delitem__(self, key):
+        if key in self._decoded:
+            del self._decoded[key]
+        elif key not in self._hidden and self._find(key) is not None:
+            self._hidden.add(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._decoded or (key not in self._hidden and
+                                        self._find(key) is not None)
+
+    def __iter__(self):
+        return iter(list(self._decoded) +
+                    [key for key, _ in self._stored()])
+
+    def __len__(self):
+        return len(self._decoded) + self._count - len(self._hidden)
+
+    def lazy_items(self):
+        """Lists every record, with undecoded ones decoded only when reached.
+
+        The listing is taken immediately, so it is not affected by later
+        changes, and records decoded while walking it are not kept in memory.
+        """
+        decoded = list(self._decoded.items())
+        undecoded = self._stored()
+        return itertools.chain(
+            decoded,
+            ((key, self._decode(offset)) for key, offset in undecoded))
+
+    def frames(self, codec):
+        """Lists the keys and frames of the records encoded with the codec."""
+        if codec.encoding != self._codec.encoding:
+            return [(key, _encode_frame(key, value, codec))
+                    for key, value in self.lazy_items()]
+        return ([(key, _encode_frame(key, value, codec))
+                 for key, value in self._decoded.items()] +
+                [(key, self._frame(offset))
+                 for key, offset in self._stored()])
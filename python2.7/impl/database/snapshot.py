@@ -0,0 +1,63 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+
+from impl.database import records
+from impl.database.shard import shard_index
+
+
+class Snapshot(object):
+    """An immutable point-in-time view of the JSON database.
+
+    Taking a snapshot is cheap: no records are copied, and writers carry on
+    while it is read; see ShardSnapshot. A snapshot should be closed once
+    done with, or used as a context manager, so that the shards stop keeping
+    the records replaced since it was taken.
+    """
+
+    def __init__(self, views):
+        self._views = views
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, key):
+        """Read the record with the given key as of the snapshot, if it existed."""
+        view = self._views[shard_index(key, len(self._views))]
+        return records.expand(view.get(key))
+
+    def items(self):
+        """Provides a way to iterate over all elements as of the snapshot."""
+        return ((key, records.expand(value))
+                for key, value in itertools.chain.from_iterable(
+                    view.items() for view in self._views))
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order as of the snapshot.
+
+        See JsonDatabase.scan().
+        """
+        pages = [view.scan(start_key, limit, prefix, inclusive)
+                 for view in self._views]
+        return [(key, records.expand(value)) for key, value in
+                itertools.islice(heapq.merge(*pages), limit)]
+
+    def close(self):
+        for view in self._views:
+            view.release()
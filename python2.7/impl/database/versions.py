@@ -0,0 +1,58 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+
+from impl.database import records
+
+
+def version(record):
+    """Returns the version of a record, or None if it does not exist.
+
+    The version is derived from the record's content, so it changes whenever
+    the record does, and every process computes the same version for it.
+    """
+    if record is None:
+        return None
+    data = json.dumps(records.expand(record), sort_keys=True,
+                      separators=(',', ':'))
+    return int(hashlib.sha1(data.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class VersionedRecords(object):
+    """Optimistic concurrency, for databases providing read() and update().
+
+    A handler reads a record with read_with_version(), does its slow work
+    without holding any lock, and writes with write_if_version(), which fails
+    if the record changed in between. The handler then starts over.
+    """
+
+    def read_with_version(self, key):
+        """Returns the record with the given key and its version."""
+        record = self.read(key)
+        return record, version(record)
+
+    def write_if_version(self, key, value, expected_version):
+        """Writes the record if its version is still expected_version.
+
+        An expected_version of None only writes the record if it does not
+        exist. Returns whether the record was written.
+        """
+        def replace(record):
+            if version(record) != expected_version:
+                return None
+            return value
+
+        return self.update(key, replace) is not None
@@ -0,0 +1,83 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from impl.common.group_commit import GroupCommitter
+
+# When greater than 0, API requests made by concurrent handlers within this
+# many milliseconds are sent together as one HTTP batch request.
+API_BATCH_WINDOW_MS = int(
+    os.environ.get('PROCUREMENT_CODELAB_API_BATCH_WINDOW_MS', 0))
+
+# Maximum number of requests sent in one batch request.
+API_BATCH_MAX_REQUESTS = int(
+    os.environ.get('PROCUREMENT_CODELAB_API_BATCH_MAX_REQUESTS', 100))
+
+
+class _Call(object):
+    """A request waiting in a batch, and its response once sent."""
+
+    def __init__(self, request):
+        self.request = request
+        self.response = None
+        self.error = None
+
+    def finish(self, request_id, response, exception):
+        self.response = response
+        self.error = exception
+
+
+class RequestBatcher(object):
+    """Sends the API requests of concurrent callers as HTTP batch requests.
+
+    Requests are gathered for up to `window_ms` milliseconds, or until there are
+    `max_requests` of them, and sent in one round trip with a
+    googleapiclient BatchHttpRequest from new_batch(). Each caller blocks
+    until the batch was sent, and gets the response to its own request, or
+    the exception executing it alone would have raised. With a window of 0,
+    each request is executed on its own.
+    """
+
+    def __init__(self, new_batch, window_ms=API_BATCH_WINDOW_MS,
+                 max_requests=API_BATCH_MAX_REQUESTS):
+        self._new_batch = new_batch
+        self._committer = None
+        if window_ms > 0:
+            self._committer = GroupCommitter(self._send, window_ms / 1000.0,
+                                             max_requests)
+
+    def execute(self, request):
+        """Executes a request, possibly in a batch with others."""
+        if self._committer is None:
+            return request.execute()
+        call = _Call(request)
+        self._committer.submit(call)
+        if call.error is not None:
+            raise call.error
+        return call.response
+
+    def _send(self, calls):
+        if len(calls) == 1:
+            # A batch of one would only add overhead.
+            call = calls[0]
+            try:
+                call.response = call.request.execute()
+            except Exception as e:
+                call.error = e
+            return
+        batch = self._new_batch()
+        for i, call in enumerate(calls):
+            batch.add(call.request, callback=call.finish, request_id=str(i))
+        batch.execute()
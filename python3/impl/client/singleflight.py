@@ -0,0 +1,86 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+
+
+class _Call(object):
+    """A call in flight, which other callers can wait for."""
+
+    def __init__(self, version):
+        self.version = version
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _covers(call_version, version):
+    """Whether a call made for call_version serves a caller needing version."""
+    if version is None:
+        return True
+    return call_version is not None and call_version >= version
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into a single call.
+
+    The first caller for a key makes the call; callers arriving while it is
+    in flight wait for it and share its result or exception, instead of
+    making the same call again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, version=None):
+        """Returns fn(), or the result of the call in flight for key.
+
+        version tells how recent the result needs to be, such as the time
+        of the event that prompted the call. A call in flight is only joined
+        if it was made for a version at least as recent; None is the oldest.
+        Returns the result and whether it was shared from another call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None or not _covers(call.version, version)
+            if leader:
+                call = _Call(version)
+                self._calls[key] = call
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn()
+            return call.value, False
+        except Exception:
+            call.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self, key):
+        """Makes later callers for key start a new call.
+
+        Callers already waiting for the call in flight still share its
+        result.
+        """
+        with self._lock:
+            self._calls.pop(key, None)
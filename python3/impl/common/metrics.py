@@ -0,0 +1,142 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets of latency histograms. The last
+# bucket holds everything slower.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsSink(object):
+    """Receives the measurements a component, such as a database, makes.
+
+    Subclass it to forward them to a monitoring system, and pass an instance
+    to the component as its metrics. Methods may be called from any thread.
+    """
+
+    def observe(self, name, value):
+        """Records one value, such as a latency in seconds, in a histogram."""
+
+    def increment(self, name, value=1):
+        """Adds to a counter."""
+
+    def set_gauge(self, name, value):
+        """Sets a value that can go up and down, such as a size."""
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Observes how long the enclosed block took, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+
+class Histogram(object):
+    """Counts values into buckets with the given upper bounds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-th quantile.
+
+        Values past the last bound are reported as infinity.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class InMemoryMetrics(MetricsSink):
+    """Keeps every measurement in memory, for snapshot() to return.
+
+    This is the default sink, so that the metrics of a running listener can
+    be inspected without setting anything up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """Returns the current value of every metric, in a dictionary.
+
+        Histograms are summarized by their count, mean and approximate
+        median, 99th percentile and maximum.
+        """
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot.update(self.gauges)
+            for name, histogram in self.histograms.items():
+                snapshot[name] = {
+                    'count': histogram.count,
+                    'mean': histogram.sum / histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                    'max': histogram.quantile(1.0),
+                }
+            return snapshot
+
+
+def timed(name):
+    """Decorates a method to observe how long each call takes.
+
+    The latency is observed, in seconds, by the object's metrics sink.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,169 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import json
+import os
+import sys
+
+from impl.database.database import open_database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# The compression used for each file extension when exporting.
+_EXTENSIONS = {
+    '.gz': GZIP,
+    '.zst': ZSTD,
+}
+
+# The first bytes of a file compressed with each compression.
+_MAGIC = {
+    b'\x1f\x8b': GZIP,
+    b'\x28\xb5\x2f\xfd': ZSTD,
+}
+
+# Number of records imported per transaction.
+IMPORT_BATCH_SIZE = 1000
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package.')
+
+
+def _open_for_writing(f, compression):
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=f, mode='wb')
+    if compression == ZSTD:
+        _require_zstandard()
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+    if compression is None:
+        return f
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def _open_for_reading(f):
+    start = f.read(4)
+    f.seek(0)
+    for magic, compression in _MAGIC.items():
+        if start.startswith(magic):
+            break
+    else:
+        return f
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    _require_zstandard()
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+
+
+def export_records(database, path, compression=None):
+    """Writes every record of the database to a file, as NDJSON.
+
+    Each line is an object holding a record's key and value. The records are
+    read from a snapshot, so the export is consistent while writers carry on,
+    and streamed to the file one by one. Unless given, the compression is
+    chosen from the file's extension: gzip for .gz, zstd for .zst, or none.
+    The file is replaced once complete. Returns the number of records.
+    """
+    if compression is None:
+        compression = _EXTENSIONS.get(os.path.splitext(path)[1])
+    tmp_path = path + '.tmp'
+    count = 0
+    with database.snapshot() as snapshot:
+        with open(tmp_path, 'wb') as f:
+            stream = _open_for_writing(f, compression)
+            for key, value in snapshot.items():
+                line = json.dumps({'key': key, 'value': value}) + '\n'
+                stream.write(line.encode('utf-8'))
+                count += 1
+            if stream is not f:
+                stream.close()
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return count
+
+
+def _rewrites_files(database):
+    """Whether each commit rewrites whole files, as without a journal."""
+    shards = getattr(database, 'shards', None)
+    return shards is not None and any(shard.journal is None
+                                      for shard in shards)
+
+
+def import_records(database, path, batch_size=IMPORT_BATCH_SIZE):
+    """Writes the records of a file made by export_records() to the database.
+
+    The compression is detected from the file's contents. Records are read
+    one line at a time and written batch_size at a time, each batch in one
+    transaction, so only one batch is held in memory. A JSON database without
+    a journal would rewrite every shard file a batch touches in full, though,
+    so there the whole import is one transaction, joined by the batches; that
+    database holds every record in memory anyway. Records of the database
+    missing from the file are left as they are. Returns the number of records.
+    """
+    if _rewrites_files(database):
+        with database.transaction():
+            return _import(database, path, batch_size)
+    return _import(database, path, batch_size)
+
+
+def _import(database, path, batch_size):
+    count = 0
+    with open(path, 'rb') as f:
+        stream = _open_for_reading(f)
+        batch = []
+        for line in stream:
+            if not line.strip():
+                continue
+            batch.append(json.loads(line.decode('utf-8')))
+            if len(batch) == batch_size:
+                count += _write_batch(database, batch)
+                batch = []
+        count += _write_batch(database, batch)
+    return count
+
+
+def _write_batch(database, batch):
+    with database.transaction():
+        for record in batch:
+            database.write(record['key'], record['value'])
+    return len(batch)
+
+
+def main(argv):
+    """Exports the database to a file, or imports one into it."""
+
+    if len(argv) != 3 or argv[1] not in ('export', 'import'):
+        print('Usage: python3 -m impl.database.backup <export|import> <file>')
+        return
+
+    database = open_database()
+    if argv[1] == 'export':
+        count = export_records(database, argv[2])
+        print('Exported {} records to {}.'.format(count, argv[2]))
+    else:
+        count = import_records(database, argv[2])
+        print('Imported {} records from {}.'.format(count, argv[2]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
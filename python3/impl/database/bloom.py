@@ -0,0 +1,59 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+# Mask taking the low 32 bits of a hash.
+_LOW_BITS = 0xffffffff
+
+
+class BloomFilter(object):
+    """A compact set of keys that can only answer "maybe" or "definitely not".
+
+    Keys cannot be removed. Sized for capacity keys, a key that was never
+    added is reported as maybe present with about the given probability; more
+    keys than that make it grow quickly.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self._size = max(8, int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._hashes = max(1, int(round(
+            float(self._size) / self.capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+        # The number of keys added, to tell when the filter is over capacity.
+        self.count = 0
+
+    def _positions(self, key):
+        # The filter only lives in memory, so Python's own string hash, which
+        # strings cache, can be used. Its two halves are enough to derive any
+        # number of hashes; see Kirsch and Mitzenmacher, "Less Hashing, Same
+        # Performance".
+        value = hash(key)
+        first = value & _LOW_BITS
+        second = (value >> 32) & _LOW_BITS | 1
+        for i in range(self._hashes):
+            yield (first + i * second) % self._size
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
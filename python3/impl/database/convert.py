@@ -0,0 +1,35 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+from impl.database.database import JsonDatabase
+
+
+def main(argv):
+    """Rewrites the JSON database in the given format and codec."""
+
+    if len(argv) != 3:
+        print('Usage: python3 -m impl.database.convert '
+              '<document|records> <json|orjson|msgpack>')
+        return
+
+    # Files are read in whatever format they are in, and committing rewrites
+    # every shard in the format and codec the database was opened with.
+    database = JsonDatabase(file_format=argv[1], codec=argv[2])
+    database.commit()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
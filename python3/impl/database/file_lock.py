@@ -0,0 +1,85 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock(object):
+    """An advisory lock on a file, shared by every process opening the database.
+
+    The lock can be held shared, by any number of processes at once, or
+    exclusively. Within a process it is held by one thread at a time, and it
+    is reentrant: a thread holding it may take it again in either mode, as
+    long as it does not ask for exclusive access while only holding it shared.
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise ImportError('Sharing the database between processes '
+                              'requires fcntl.')
+        self.path = path
+        self._file = None
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._exclusive = False
+
+    def shared(self):
+        return self._hold(False)
+
+    def exclusive(self):
+        return self._hold(True)
+
+    @contextlib.contextmanager
+    def _hold(self, exclusive):
+        with self._lock:
+            if self._depth == 0:
+                if self._file is None:
+                    self._file = open(self.path, 'ab')
+                fcntl.flock(self._file.fileno(),
+                            fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._exclusive = exclusive
+            elif exclusive and not self._exclusive:
+                raise RuntimeError('A shared file lock cannot be upgraded.')
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def _unlocked():
+    yield
+
+
+def exclusive(file_lock):
+    """Holds the given FileLock exclusively, if it is not None."""
+    if file_lock is None:
+        return _unlocked()
+    return file_lock.exclusive()
+
+
+def shared(file_lock):
+    """Holds the given FileLock shared, if it is not None."""
+    if file_lock is None:
+        return _unlocked()
+    return file_lock.shared()
@@ -0,0 +1,160 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+CONSUMER_ID = 'consumer_id'
+INTERNAL_ACCOUNT_ID = 'internal_account_id'
+PRODUCT = 'product'
+PLAN = 'plan'
+
+
+def _products(customer):
+    return (customer.get('products') or {}).values()
+
+
+def _consumer_ids(customer):
+    return [p['consumer_id'] for p in _products(customer) if 'consumer_id' in p]
+
+
+def _internal_account_ids(customer):
+    if 'internal_account_id' in customer:
+        return [customer['internal_account_id']]
+    return []
+
+
+def _product_ids(customer):
+    return list(customer.get('products') or {})
+
+
+def _plan_ids(customer):
+    return [p['plan_id'] for p in _products(customer) if 'plan_id' in p]
+
+
+# The values each index maps back to the keys of the customers holding them.
+_EXTRACTORS = {
+    CONSUMER_ID: _consumer_ids,
+    INTERNAL_ACCOUNT_ID: _internal_account_ids,
+    PRODUCT: _product_ids,
+    PLAN: _plan_ids,
+}
+
+
+def index_entries(customer):
+    """Returns the (index name, value) pairs under which a customer is indexed."""
+    if not customer:
+        return set()
+    if hasattr(customer, 'to_dict'):
+        customer = customer.to_dict()
+    return set((name, value)
+               for name, extract in _EXTRACTORS.items()
+               for value in extract(customer))
+
+
+class CustomerIndexes(object):
+    """In-memory secondary indexes over customer records, built on first use.
+
+    Each index maps a value, such as a consumer ID or a plan ID, to the set of
+    keys of the customers holding it, so that lookups take time proportional
+    to the number of matches rather than the number of customers.
+    """
+
+    def __init__(self, items):
+        self._items = items
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        """Builds every index from all customers on first use.
+
+        Building is deferred so that opening the database does not have to
+        decode every record. A change made while the indexes are built is
+        applied once they are done; since it only adds and removes the entries
+        that differ, it is correct whether or not the build saw it.
+        """
+        self._entries = {}
+        for key, customer in self._items():
+            self._apply(key, set(), index_entries(customer))
+
+    def update(self, key, old, new):
+        """Re-indexes a customer whose record changed from old to new."""
+        with self._lock:
+            if self._entries is None:
+                return
+            self._apply(key, index_entries(old), index_entries(new))
+
+    def reset(self):
+        """Drops every index, to be built again from all customers on next use."""
+        with self._lock:
+            self._entries = None
+
+    def _apply(self, key, old_entries, new_entries):
+        for entry in old_entries - new_entries:
+            keys = self._entries.get(entry)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._entries[entry]
+        for entry in new_entries - old_entries:
+            self._entries.setdefault(entry, set()).add(key)
+
+    def keys(self, name, value):
+        """Returns the keys of the customers indexed under the given value."""
+        with self._lock:
+            if self._entries is None:
+                self._build()
+            return sorted(self._entries.get((name, value), ()))
+
+
+class IndexQueries(object):
+    """Lookups by secondary index, for databases providing _index_keys()."""
+
+    def _index_keys(self, name, value):
+        raise NotImplementedError()
+
+    def _find_one(self, name, value):
+        for key in self._index_keys(name, value):
+            customer = self.read(key)
+            if customer is not None:
+                return customer
+        return None
+
+    def _find_all(self, name, value):
+        customers = (self.read(key) for key in self._index_keys(name, value))
+        return [customer for customer in customers if customer is not None]
+
+    def find_by_consumer_id(self, consumer_id):
+        """Returns the customer reporting usage under the given consumer ID.
+
+        The consumer ID is the usageReportingId of the customer's entitlement.
+        """
+        return self._find_one(CONSUMER_ID, consumer_id)
+
+    def find_by_internal_account_id(self, internal_account_id):
+        """Returns the customer with the given internal account ID, if any."""
+        return self._find_one(INTERNAL_ACCOUNT_ID, internal_account_id)
+
+    def customers_on_product(self, product_id):
+        """Returns every customer with an active entitlement to the product."""
+        return self._find_all(PRODUCT, product_id)
+
+    def customers_on_plan(self, plan_id, product_id=None):
+        """Returns every customer on the given plan, optionally of one product."""
+        customers = self._find_all(PLAN, plan_id)
+        return [
+            customer for customer in customers
+            if any(p.get('plan_id') == plan_id and
+                   product_id in (None, p.get('product_id'))
+                   for p in customer['products'].values())
+        ]
@@ -0,0 +1,322 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+from impl.database import serialization
+
+# Durability policies, trading write latency against how much may be lost.
+# Every flush is synced to disk before writers are told it succeeded.
+DURABILITY_ALWAYS = 'always'
+# Flushes are synced at most once per interval; a crash can lose that interval.
+# Files that are rewritten and renamed into place are still synced every time,
+# since renaming an unsynced file could lose all of its records, not just the
+# latest.
+DURABILITY_INTERVAL = 'interval'
+# Flushes are handed to the operating system, which decides when to sync.
+DURABILITY_OS = 'os'
+
+# A journal starts with a header naming its encoding (see
+# impl/database/serialization.py). Journals written before the encoding was
+# configurable have no header and hold JSON.
+LAYOUT = 'journal'
+
+# Every journal record is framed by its payload length and a CRC32 of the
+# payload, so a record torn by a crash in the middle of an append is detected.
+_FRAME_HEADER = struct.Struct('>II')
+
+
+def _crc32(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+
+def _stat(path):
+    """Returns the inode and size of the file at path, or None and 0."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, 0
+    return stat.st_ino, stat.st_size
+
+
+def encode_record(record, codec):
+    """Encodes a single journal record into its on-disk frame."""
+    payload = codec.dumps(record)
+    return _FRAME_HEADER.pack(len(payload), _crc32(payload)) + payload
+
+
+def apply_record(database, record):
+    """Applies a single journal record to the given dictionary."""
+    if record['op'] == 'write':
+        database[record['key']] = record['value']
+    elif record['op'] == 'delete':
+        database.pop(record['key'], None)
+    elif record['op'] == 'batch':
+        for inner in record['records']:
+            apply_record(database, inner)
+
+
+def flatten(records):
+    """Yields the write and delete records in the given records, in order."""
+    for record in records:
+        if record['op'] == 'batch':
+            for inner in flatten(record['records']):
+                yield inner
+        else:
+            yield record
+
+
+def write_record(key, value):
+    return {'op': 'write', 'key': key, 'value': value}
+
+
+def delete_record(key):
+    return {'op': 'delete', 'key': key}
+
+
+def batch_record(records):
+    """Groups records into one, which is replayed either in full or not at all.
+
+    The records must all belong to the same shard.
+    """
+    return {'op': 'batch', 'records': records}
+
+
+def record_key(record):
+    """Returns the key of the record, or of the first one in a batch."""
+    if record['op'] == 'batch':
+        return record_key(record['records'][0])
+    return record['key']
+
+
+def atomic_write(path, data, sync=True):
+    """Replaces the file at the given path with the given bytes.
+
+    The data is written to a temporary file which is flushed to disk and then
+    renamed over the original, so readers never observe a partial file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class SyncPolicy(object):
+    """Decides when flushed writes are synced to disk.
+
+    With the interval policy, files left unsynced by a flush are synced by a
+    timer once the interval is over, so writes followed by a quiet period are
+    not left unsynced until the next write.
+    """
+
+    def __init__(self, durability=DURABILITY_ALWAYS, interval=1.0):
+        if durability not in (DURABILITY_ALWAYS, DURABILITY_INTERVAL,
+                              DURABILITY_OS):
+            raise ValueError('Unknown durability policy: {}'.format(durability))
+        self.durability = durability
+        self.interval = interval
+        self._last_sync = 0
+        self._unsynced = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def sync(self, f):
+        """Syncs the flushed file if the policy requires it right now."""
+        if self.durability == DURABILITY_ALWAYS:
+            os.fsync(f.fileno())
+        elif self.durability == DURABILITY_INTERVAL:
+            with self._lock:
+                if f not in self._unsynced:
+                    self._unsynced.append(f)
+                due = self._last_sync + self.interval - time.time()
+                if due > 0 and self._timer is None:
+                    self._timer = threading.Timer(due, self._sync_due)
+                    self._timer.daemon = True
+                    self._timer.start()
+            if due <= 0:
+                self.sync_pending()
+
+    def _sync_due(self):
+        with self._lock:
+            self._timer = None
+        self.sync_pending()
+
+    def sync_pending(self):
+        """Syncs every file flushed since the last sync."""
+        with self._lock:
+            unsynced, self._unsynced = self._unsynced, []
+            self._last_sync = time.time()
+        for f in unsynced:
+            try:
+                os.fsync(f.fileno())
+            except (OSError, ValueError):
+                # The journal was closed by a compaction, which synced the
+                # snapshot holding its records.
+                pass
+
+    @property
+    def sync_on_write(self):
+        """Whether files rewritten with atomic_write() are synced first."""
+        return self.durability != DURABILITY_OS
+
+
+class Journal(object):
+    """Append-only log of the mutations made since the last snapshot."""
+
+    def __init__(self, path, policy=None, codec=None):
+        self.path = path
+        self.policy = policy or SyncPolicy()
+        self.codec = codec or serialization.JsonCodec()
+        # The encoding of the records in the journal, or None if it is empty.
+        self.encoding = None
+        self.records = 0
+        # The size and inode of the journal as of the last replay or append,
+        # which tell whether another process changed it since.
+        self.size = 0
+        self._inode = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def replay(self, database):
+        """Applies every complete record in the journal to the dictionary."""
+        for record in self.read_all():
+            apply_record(database, record)
+
+    def read_all(self):
+        """Returns every complete record in the journal.
+
+        Reading stops at the first record that is incomplete or fails its
+        checksum, which is what a crash in the middle of an append leaves
+        behind. The journal is truncated to the last good record so that new
+        appends follow valid data.
+        """
+        self.records = 0
+        self.encoding = None
+        self.size = 0
+        self._inode = None
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        records = self._parse(data)
+
+        if self.size < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.size)
+                f.flush()
+                os.fsync(f.fileno())
+        self._inode = _stat(self.path)[0]
+        return records
+
+    def _parse(self, data):
+        """Decodes the complete records in data, which follows self.size.
+
+        self.size is advanced past them, and self.encoding is set from the
+        header if data starts the journal.
+        """
+        if not data:
+            return []
+        offset = 0
+        if self.size == 0:
+            self.encoding = 'json'
+            header = serialization.parse_header(data)
+            if header is not None:
+                _, self.encoding, offset = header
+        codec = serialization.codec_for_encoding(self.encoding, self.codec)
+
+        records = []
+        while offset + _FRAME_HEADER.size <= len(data):
+            length, crc = _FRAME_HEADER.unpack_from(data, offset)
+            start = offset + _FRAME_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or _crc32(payload) != crc:
+                break
+            records.append(codec.loads(payload))
+            offset = start + length
+        self.size += offset
+        self.records += len(records)
+        return records
+
+    def changed(self):
+        """Whether another process appended to or replaced the journal."""
+        return _stat(self.path) != (self._inode, self.size)
+
+    def read_tail(self):
+        """Returns the records appended by other processes since the last read.
+
+        Returns None if the journal was replaced, by a compaction in another
+        process, in which case the shard has to be loaded again. The caller
+        holds the database's file lock, so no append is in progress.
+        """
+        inode, size = _stat(self.path)
+        if inode != self._inode or size < self.size:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(self.size)
+            data = f.read(size - self.size)
+        return self._parse(data)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def append(self, records):
+        """Appends the given records and flushes them per the sync policy.
+
+        Returns the number of bytes written.
+        """
+        data = b''.join(encode_record(r, self.codec) for r in records)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+                self._inode = os.fstat(self._file.fileno()).st_ino
+            if self.encoding is None:
+                data = serialization.make_header(LAYOUT, self.codec) + data
+                self.encoding = self.codec.encoding
+            self._file.write(data)
+            self._file.flush()
+            self.policy.sync(self._file)
+            self.records += len(records)
+            self.size += len(data)
+        return len(data)
+
+    def reset(self):
+        """Empties the journal after its records were folded into a snapshot."""
+        self.rewrite([])
+
+    def rewrite(self, records):
+        """Atomically replaces the contents of the journal with the records."""
+        data = b''
+        if records:
+            data = serialization.make_header(LAYOUT, self.codec) + b''.join(
+                encode_record(r, self.codec) for r in records)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            atomic_write(self.path, data, self.policy.sync_on_write)
+            self.records = len(records)
+            self.encoding = self.codec.encoding if records else None
+            self.size = len(data)
+            self._inode = _stat(self.path)[0]
@@ -0,0 +1,251 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import copy
+import re
+import sys
+import time
+
+try:
+    intern = sys.intern
+    _STRING_TYPES = (str,)
+except AttributeError:
+    _STRING_TYPES = (str, unicode)
+
+# Marks a field that is absent from a record, as opposed to one set to None.
+_ABSENT = object()
+
+_CUSTOMER_FIELDS = ('procurement_account_id', 'internal_account_id')
+_PRODUCT_FIELDS = ('product_id', 'plan_id', 'start_time', 'consumer_id',
+                   'last_report_time')
+
+# Product fields holding timestamps, which are kept as integers.
+_TIMESTAMP_FIELDS = ('start_time', 'last_report_time')
+
+_TIMESTAMP = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?Z$')
+
+_SECONDS_PER_DAY = 86400
+
+# Python 2 decodes JSON strings as unicode, which intern() does not take, so
+# those are interned through this table instead.
+_INTERNED_UNICODE = {}
+
+# Dates seen in timestamps, and the other way round, the days since the epoch
+# they fall on. Records share few distinct dates, so these stay small, and
+# parsing and formatting a timestamp only does arithmetic on its time of day.
+_DAYS = {}
+_DATES = {}
+
+
+def _day(date):
+    """Returns the days since the epoch of a YYYY-MM-DD date, or None."""
+    day = _DAYS.get(date)
+    if day is None:
+        try:
+            seconds = calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+        except ValueError:
+            return None
+        day = seconds // _SECONDS_PER_DAY
+        _DAYS[date] = day
+        _DATES[day] = date
+    return day
+
+
+def _date(day):
+    date = _DATES.get(day)
+    if date is None:
+        date = time.strftime('%Y-%m-%d', time.gmtime(day * _SECONDS_PER_DAY))
+        _DAYS[date] = day
+        _DATES[day] = date
+    return date
+
+
+def _format_fraction(nanos):
+    """Formats a fraction of a second with 0, 3, 6 or 9 digits."""
+    if not nanos:
+        return ''
+    digits = 9
+    while digits > 3 and nanos % 1000 == 0:
+        nanos //= 1000
+        digits -= 3
+    return '.{:0{}d}'.format(nanos, digits)
+
+
+def _parse_timestamp(value):
+    """Converts an RFC 3339 UTC timestamp into nanoseconds since the epoch.
+
+    Returns None for anything that would not be formatted back into the exact
+    same string, so that the conversion is always lossless.
+    """
+    if not isinstance(value, _STRING_TYPES):
+        return None
+    match = _TIMESTAMP.match(value)
+    if not match:
+        return None
+    date, hours, minutes, seconds, fraction = match.groups()
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    day = _day(date)
+    if day is None or hours > 23 or minutes > 59 or seconds > 59:
+        return None
+    nanos = int(fraction.ljust(9, '0')) if fraction else 0
+    if _format_fraction(nanos) != ('.' + fraction if fraction else ''):
+        return None
+    seconds += day * _SECONDS_PER_DAY + hours * 3600 + minutes * 60
+    return seconds * 1000000000 + nanos
+
+
+def _format_timestamp(value):
+    """Formats nanoseconds since the epoch like the Google APIs do."""
+    seconds, nanos = divmod(value, 1000000000)
+    day, seconds = divmod(seconds, _SECONDS_PER_DAY)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}T{:02d}:{:02d}:{:02d}{}Z'.format(
+        _date(day), hours, minutes, seconds, _format_fraction(nanos))
+
+
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    if type(value) in _STRING_TYPES:
+        return _INTERNED_UNICODE.setdefault(value, value)
+    return value
+
+
+class Product(object):
+    """Compact in-memory form of one product entry of a customer record.
+
+    Product and plan IDs, which repeat across customers, are interned, and
+    timestamps are held as integers.
+    """
+
+    __slots__ = _PRODUCT_FIELDS + ('extra',)
+
+    @classmethod
+    def from_dict(cls, product):
+        product = dict(product)
+        self = cls()
+        self.product_id = _intern(product.pop('product_id', _ABSENT))
+        self.plan_id = _intern(product.pop('plan_id', _ABSENT))
+        self.consumer_id = product.pop('consumer_id', _ABSENT)
+        for field in _TIMESTAMP_FIELDS:
+            timestamp = _parse_timestamp(product.get(field))
+            if timestamp is None:
+                setattr(self, field, _ABSENT)
+            else:
+                setattr(self, field, timestamp)
+                del product[field]
+        self.extra = copy.deepcopy(product) if product else None
+        return self
+
+    def to_dict(self):
+        product = {}
+        for field in _PRODUCT_FIELDS:
+            value = getattr(self, field)
+            if value is _ABSENT:
+                continue
+            if field in _TIMESTAMP_FIELDS:
+                value = _format_timestamp(value)
+            product[field] = value
+        if self.extra:
+            product.update(copy.deepcopy(self.extra))
+        return product
+
+    def __eq__(self, other):
+        return (type(other) is Product and
+                all(getattr(self, field) == getattr(other, field)
+                    for field in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+class Customer(object):
+    """Compact in-memory form of a customer record.
+
+    Converts losslessly to and from the dictionary the handlers and usage
+    reporting work with; fields other than the known ones are kept as-is.
+    """
+
+    __slots__ = _CUSTOMER_FIELDS + ('products', 'extra')
+
+    @classmethod
+    def from_dict(cls, customer):
+        customer = dict(customer)
+        self = cls()
+        self.procurement_account_id = customer.pop('procurement_account_id',
+                                                   _ABSENT)
+        self.internal_account_id = customer.pop('internal_account_id', _ABSENT)
+        # A tuple of (product ID, product) pairs takes less memory than a
+        # dictionary, and customers only have a handful of products.
+        self.products = tuple(
+            (_intern(product_id), Product.from_dict(product))
+            for product_id, product in customer.pop('products').items())
+        self.extra = copy.deepcopy(customer) if customer else None
+        return self
+
+    def to_dict(self):
+        customer = {}
+        for field in _CUSTOMER_FIELDS:
+            value = getattr(self, field)
+            if value is not _ABSENT:
+                customer[field] = value
+        customer['products'] = dict(
+            (product_id, product.to_dict())
+            for product_id, product in self.products)
+        if self.extra:
+            customer.update(copy.deepcopy(self.extra))
+        return customer
+
+    def __eq__(self, other):
+        return (type(other) is Customer and
+                all(getattr(self, field) == getattr(other, field)
+                    for field in _CUSTOMER_FIELDS + ('extra',)) and
+                dict(self.products) == dict(other.products))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+def _is_customer(value):
+    return (isinstance(value, dict) and
+            isinstance(value.get('products'), dict) and
+            all(isinstance(p, dict) for p in value['products'].values()))
+
+
+def compact(value):
+    """Returns the compact form of a record, or a copy if it has none."""
+    if _is_customer(value):
+        return Customer.from_dict(value)
+    return copy.deepcopy(value)
+
+
+def same(a, b):
+    """Whether two records, each compact or not, hold the same data."""
+    if type(a) is type(b):
+        return a == b
+    return expand(a) == expand(b)
+
+
+def expand(value):
+    """Returns a new dictionary for a record stored by compact()."""
+    if isinstance(value, Customer):
+        return value.to_dict()
+    return copy.deepcopy(value)
@@ -0,0 +1,447 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import copy
+import json
+import os
+import threading
+
+from impl.common.metrics import InMemoryMetrics, timed
+from impl.database.index import IndexQueries, index_entries
+from impl.database import key_range
+from impl.database.versions import VersionedRecords
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# The Redis server the database is stored on.
+REDIS_URL = os.environ.get('PROCUREMENT_CODELAB_DATABASE_REDIS_URL',
+                           'redis://localhost:6379/0')
+
+# Prefix of every Redis key the database uses, so that several databases can
+# share one Redis server.
+REDIS_PREFIX = os.environ.get('PROCUREMENT_CODELAB_DATABASE_REDIS_PREFIX',
+                              'procurement:')
+
+# Maximum number of connections each process keeps open to the Redis server.
+REDIS_MAX_CONNECTIONS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_REDIS_MAX_CONNECTIONS', 16))
+
+# Number of keys asked for per SCAN, and records fetched per round trip, while
+# iterating over the database.
+_PAGE_SIZE = 1000
+
+# Number of times snapshot() copies the records a page at a time, starting over
+# whenever a commit happens meanwhile, before copying them all at once.
+_SNAPSHOT_ATTEMPTS = 5
+
+# The kinds of change a transaction stages for a record.
+_WRITE = 'write'
+_DELETE = 'delete'
+_UPDATE = 'update'
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _decode(fields):
+    """Converts the fields of a customer hash back into a record, or None."""
+    if not fields:
+        return None
+    return dict((_text(field), json.loads(_text(value)))
+                for field, value in fields.items())
+
+
+def _encode(record):
+    return dict((field, json.dumps(value, sort_keys=True))
+                for field, value in record.items())
+
+
+def _resolve(change, record):
+    """Returns the record that a staged change turns the given one into."""
+    kind, argument = change
+    if kind == _WRITE:
+        return argument
+    if kind == _DELETE:
+        return None
+    value = argument(copy.deepcopy(record))
+    return record if value is None else value
+
+
+class _Transaction(object):
+    """The changes staged by a transaction, in the order they were made."""
+
+    def __init__(self):
+        self.changes = []
+
+    def staged(self, key):
+        return [change for k, change in self.changes if k == key]
+
+
+class RedisDatabase(IndexQueries, VersionedRecords):
+    """Redis-based implementation of the database, with the JsonDatabase API.
+
+    Every customer is a Redis hash, with one JSON-encoded field per top-level
+    field of its record, so a change only sends the fields that differ. The
+    set of all keys and the secondary indexes are Redis sets kept up to date
+    in the same MULTI/EXEC transaction as the records, which makes it safe for
+    several listener replicas to share one Redis server. The set of keys is
+    a sorted set, with every score 0, so that it can be scanned in key order.
+    Every commit that changes a record also bumps a version counter, which
+    snapshot() checks to tell whether its copy is consistent.
+
+    Changes are optimistic: the records are WATCHed while read, and the
+    change is retried from a fresh read if another client changed them before
+    it was committed. The function passed to update() may therefore be called
+    more than once, and should only compute the new record.
+
+    A client may be passed in, such as a fakeredis.FakeRedis, instead of one
+    being connected to REDIS_URL. It is shared by every thread, and borrows a
+    connection from its pool for each command or pipeline.
+
+    As with JsonDatabase, the latency of reads, writes, deletes and updates is
+    measured into metrics, along with the writes skipped and changes made.
+    """
+
+    def __init__(self, client=None, url=REDIS_URL, prefix=REDIS_PREFIX,
+                 max_connections=REDIS_MAX_CONNECTIONS, metrics=None):
+        if client is None:
+            if redis is None:
+                raise ImportError('The Redis backend requires the redis '
+                                  'package.')
+            pool = redis.ConnectionPool.from_url(
+                url, max_connections=max_connections)
+            client = redis.Redis(connection_pool=pool)
+        self.client = client
+        self.prefix = prefix
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
+        self.change_feed = False
+        self.writes_skipped = 0
+        self.changes_committed = 0
+        self._counters_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _record_key(self, key):
+        return '{}customer:{}'.format(self.prefix, key)
+
+    def _keys_key(self):
+        return '{}customers'.format(self.prefix)
+
+    def _index_key(self, name, value):
+        return '{}index:{}:{}'.format(self.prefix, name, value)
+
+    def _version_key(self):
+        return '{}version'.format(self.prefix)
+
+    def _fetch(self, keys):
+        """Reads several records in a single round trip."""
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hgetall(self._record_key(key))
+        return [_decode(fields) for fields in pipeline.execute()]
+
+    def _index_keys(self, name, value):
+        return sorted(_text(key) for key in
+                      self.client.smembers(self._index_key(name, value)))
+
+    @timed('read')
+    def read(self, key):
+        """Read the record with the given key from the database, if it exists."""
+        value = _decode(self.client.hgetall(self._record_key(key)))
+        transaction = self._transaction()
+        if transaction is not None:
+            for change in transaction.staged(key):
+                value = _resolve(change, value)
+        return value
+
+    @timed('write')
+    def write(self, key, value):
+        """Write the record with the given key to the database."""
+        self._change(key, (_WRITE, copy.deepcopy(value)))
+
+    @timed('delete')
+    def delete(self, key):
+        """Delete the record with the given key from the database, if it exists."""
+        self._change(key, (_DELETE, None))
+
+    @timed('update')
+    def update(self, key, fn):
+        """Atomically replaces the record with the given key with fn(record).
+
+        fn receives a copy of the current record, or None if it does not exist,
+        and returns the record to write. If it returns None, the record is left
+        unchanged. If the record changes before the new one is written, fn is
+        called again with the latest record.
+        """
+        results = []
+
+        def apply(record):
+            results.append(fn(record))
+            return results[-1]
+
+        transaction = self._transaction()
+        if transaction is not None:
+            apply(self.read(key))
+        self._change(key, (_UPDATE, apply))
+        return results[-1]
+
+    def _change(self, key, change):
+        transaction = self._transaction()
+        if transaction is not None:
+            transaction.changes.append((key, change))
+        else:
+            self._commit([(key, change)])
+
+    def _transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits the writes and deletes made within on this thread together.
+
+        Changes are staged until the block ends, then committed in one
+        MULTI/EXEC transaction; reads within the block see them. If the block
+        raises an exception, nothing is changed. A transaction started within
+        another joins it.
+        """
+        if self._transaction() is not None:
+            yield
+            return
+        transaction = _Transaction()
+        self._local.transaction = transaction
+        try:
+            yield
+        finally:
+            self._local.transaction = None
+        if transaction.changes:
+            self._commit(transaction.changes)
+
+    def _commit(self, changes):
+        """Applies the changes atomically, retrying if their records change."""
+        keys = []
+        for key, _ in changes:
+            if key not in keys:
+                keys.append(key)
+        record_keys = [self._record_key(key) for key in keys]
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(*record_keys)
+                    old = dict(zip(keys, self._fetch(keys)))
+                    new = dict(old)
+                    for key, change in changes:
+                        new[key] = _resolve(change, new[key])
+                    changed = [key for key in keys if new[key] != old[key]]
+                    pipeline.multi()
+                    for key in changed:
+                        self._queue(pipeline, key, old[key], new[key])
+                    if changed:
+                        pipeline.incr(self._version_key())
+                    pipeline.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        self._count(skipped=len(keys) - len(changed),
+                    committed=len(changed))
+
+    def _queue(self, pipeline, key, old, new):
+        """Queues the commands changing a record from old to new."""
+        record_key = self._record_key(key)
+        if new is None:
+            pipeline.delete(record_key)
+            pipeline.zrem(self._keys_key(), key)
+        else:
+            old_fields = _encode(old or {})
+            new_fields = _encode(new)
+            removed = [field for field in old_fields if field not in new_fields]
+            if removed:
+                pipeline.hdel(record_key, *removed)
+            changed = dict((field, value) for field, value in new_fields.items()
+                           if old_fields.get(field) != value)
+            if changed:
+                pipeline.hset(record_key, mapping=changed)
+            if old is None:
+                pipeline.zadd(self._keys_key(), {key: 0})
+        old_entries = index_entries(old)
+        new_entries = index_entries(new)
+        for name, value in old_entries - new_entries:
+            pipeline.srem(self._index_key(name, value), key)
+        for name, value in new_entries - old_entries:
+            pipeline.sadd(self._index_key(name, value), key)
+
+    def _count(self, skipped=0, committed=0):
+        with self._counters_lock:
+            self.writes_skipped += skipped
+            self.changes_committed += committed
+        if skipped:
+            self.metrics.increment('writes_skipped', skipped)
+        if committed:
+            self.metrics.increment('changes_committed', committed)
+
+    def changes(self, since=0):
+        raise ValueError('The Redis backend has no change feed.')
+
+    def items(self):
+        """Provides a way to iterate over all elements in the database.
+
+        Keys are listed with SCAN, a page at a time, and the records of each
+        page fetched in one round trip, so records may be written while
+        iterating. Use snapshot() for a consistent view.
+        """
+        seen = set()
+        keys = []
+        pattern = self._record_key('*')
+        start = len(self._record_key(''))
+        for record_key in self.client.scan_iter(match=pattern,
+                                                count=_PAGE_SIZE):
+            key = _text(record_key)[start:]
+            # SCAN may return a key more than once.
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            if len(keys) == _PAGE_SIZE:
+                for item in self._page(keys):
+                    yield item
+                keys = []
+        for item in self._page(keys):
+            yield item
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order, as (key, record) pairs.
+
+        See JsonDatabase.scan().
+        """
+        first, inclusive = key_range.lower_bound(start_key, prefix, inclusive)
+        last = key_range.prefix_end(prefix)
+        keys = self.client.zrangebylex(
+            self._keys_key(), ('[' if inclusive else '(') + first,
+            '+' if last is None else '(' + last,
+            start=None if limit is None else 0, num=limit)
+        return self._page([_text(key) for key in keys])
+
+    def _page(self, keys):
+        return [(key, value) for key, value in zip(keys, self._fetch(keys))
+                if value is not None]
+
+    def snapshot(self):
+        """Returns a consistent RedisSnapshot of the database as of now.
+
+        Redis has no snapshots of its own, so every record is copied into
+        memory; avoid taking snapshots of very large databases, such as by
+        running the usage reporting script against them. The records are
+        copied a page at a time, so that the server, which every listener
+        shares, is only ever busy with one page. If a commit happens while
+        copying, the copy starts over, and after _SNAPSHOT_ATTEMPTS tries it
+        is taken in a single MULTI/EXEC transaction instead.
+        """
+        for _ in range(_SNAPSHOT_ATTEMPTS):
+            items = self._copy_pages()
+            if items is not None:
+                return RedisSnapshot(items)
+        return RedisSnapshot(self._copy_all())
+
+    def _copy_pages(self):
+        """Copies every record, or returns None if a commit happened meanwhile.
+
+        Each page is read in a MULTI/EXEC transaction along with the version
+        counter, so the copy is consistent if the version never changed.
+        """
+        version_key = self._version_key()
+        version = self.client.get(version_key)
+        items = []
+        last = None
+        while True:
+            keys = [_text(key) for key in self.client.zrangebylex(
+                self._keys_key(), '-' if last is None else '(' + last, '+',
+                start=0, num=_PAGE_SIZE)]
+            if not keys:
+                break
+            with self.client.pipeline() as pipeline:
+                pipeline.get(version_key)
+                for key in keys:
+                    pipeline.hgetall(self._record_key(key))
+                results = pipeline.execute()
+            if results[0] != version:
+                return None
+            items.extend((key, _decode(fields))
+                         for key, fields in zip(keys, results[1:]) if fields)
+            last = keys[-1]
+        # Records may have been added or removed after the last page was read.
+        if self.client.get(version_key) != version:
+            return None
+        return items
+
+    def _copy_all(self):
+        """Copies every record in a single MULTI/EXEC transaction."""
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    # Adding or removing a record changes the set of keys, so
+                    # the records read below are exactly those that exist.
+                    pipeline.watch(self._keys_key())
+                    keys = [_text(key) for key in
+                            pipeline.zrange(self._keys_key(), 0, -1)]
+                    pipeline.multi()
+                    for key in keys:
+                        pipeline.hgetall(self._record_key(key))
+                    values = pipeline.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        return [(key, _decode(fields))
+                for key, fields in zip(keys, values) if fields]
+
+
+class RedisSnapshot(object):
+    """An immutable point-in-time copy of the Redis database.
+
+    Every record is held in memory until the snapshot is closed; see
+    RedisDatabase.snapshot().
+    """
+
+    def __init__(self, items):
+        self._records = dict(items)
+        self._sorted_keys = sorted(self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, key):
+        """Read the record with the given key as of the snapshot, if it existed."""
+        return copy.deepcopy(self._records.get(key))
+
+    def items(self):
+        """Provides a way to iterate over all elements as of the snapshot."""
+        for key in self._sorted_keys:
+            yield key, copy.deepcopy(self._records[key])
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order as of the snapshot."""
+        return [(key, copy.deepcopy(self._records[key]))
+                for key in key_range.select(self._sorted_keys, start_key, limit,
+                                            prefix, inclusive)]
+
+    def close(self):
+        self._records = {}
+        self._sorted_keys = []
@@ -0,0 +1,145 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Database files other than a plain JSON object start with a header line naming
+# their layout and the encoding of their records, e.g. b'PCDB2 records json\n'.
+# Record files written before the encoding was configurable start with
+# b'PCDB1\n' and hold JSON.
+_HEADER_PREFIX = b'PCDB2 '
+_LEGACY_RECORDS_HEADER = b'PCDB1\n'
+_MAX_HEADER_LENGTH = 64
+
+
+def _default(value):
+    """Serializes the compact records of impl/database/records.py."""
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError('Cannot serialize {!r}'.format(value))
+    return to_dict()
+
+
+class JsonCodec(object):
+    """Encodes records as JSON using the standard library."""
+
+    name = 'json'
+    encoding = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value, default=_default).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+class OrjsonCodec(object):
+    """Encodes records as JSON using orjson, which is several times faster."""
+
+    name = 'orjson'
+    encoding = 'json'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('The orjson codec requires the orjson package.')
+
+    def dumps(self, value):
+        return orjson.dumps(value, default=_default)
+
+    def loads(self, data):
+        return orjson.loads(bytes(data))
+
+
+class MsgpackCodec(object):
+    """Encodes records in the binary MessagePack format."""
+
+    name = 'msgpack'
+    encoding = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('The msgpack codec requires the msgpack package.')
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=_default, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(bytes(data), raw=False)
+
+
+_CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name):
+    """Returns the codec with the given name."""
+    if name not in _CODECS:
+        raise ValueError('Unknown database codec: {}'.format(name))
+    return _CODECS[name]()
+
+
+def codec_for_encoding(encoding, preferred):
+    """Returns a codec reading the given encoding, preferring the given codec.
+
+    This lets a database configured to use orjson read files written by the
+    standard library's JSON codec, and the other way around.
+    """
+    if preferred.encoding == encoding:
+        return preferred
+    if encoding == 'json':
+        return JsonCodec()
+    return get_codec(encoding)
+
+
+def make_header(layout, codec):
+    """Returns the header line for a file with the given layout and codec."""
+    return _HEADER_PREFIX + '{} {}\n'.format(layout, codec.encoding).encode(
+        'ascii')
+
+
+def parse_header(data):
+    """Parses the header at the start of the given bytes.
+
+    Returns the layout, the encoding and the length of the header, or None
+    if the data does not start with a header.
+    """
+    if data[:len(_LEGACY_RECORDS_HEADER)] == _LEGACY_RECORDS_HEADER:
+        return 'records', 'json', len(_LEGACY_RECORDS_HEADER)
+    if data[:len(_HEADER_PREFIX)] != _HEADER_PREFIX:
+        return None
+    end = bytes(data[:_MAX_HEADER_LENGTH]).find(b'\n')
+    if end < 0:
+        raise ValueError('Malformed database file header')
+    layout, encoding = bytes(
+        data[len(_HEADER_PREFIX):end]).decode('ascii').split(' ')
+    return layout, encoding, end + 1
+
+
+def read_header(path):
+    """Parses the header of the file at the given path; see parse_header()."""
+    with open(path, 'rb') as f:
+        return parse_header(f.read(_MAX_HEADER_LENGTH))
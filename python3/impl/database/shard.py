@@ -0,0 +1,360 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import os
+import threading
+import weakref
+import zlib
+
+from impl.database import journal
+from impl.database.file_lock import FileLock
+from impl.database import key_range
+from impl.database import record_file
+from impl.database import records
+from impl.database import serialization
+
+# The database file is a single object mapping keys to records. Encoded as
+# JSON, this is the original database file format, which has no header.
+FORMAT_DOCUMENT = 'document'
+# The database file is a record file, which is loaded lazily.
+FORMAT_RECORDS = record_file.LAYOUT
+
+# Marks a record that did not exist when a snapshot was taken.
+_MISSING = object()
+
+
+def shard_index(key, shard_count):
+    """Returns the shard holding the given key.
+
+    A CRC of the key is used rather than hash(), which differs between
+    processes, so that every process maps a key to the same shard file.
+    """
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+def _signature(path):
+    """Identifies the version of a file, which every rewrite replaces."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def shard_path(path, index, shard_count):
+    """Returns the file backing one shard of the database at the given path."""
+    if shard_count == 1:
+        return path
+    return '{}.{}-of-{}'.format(path, index, shard_count)
+
+
+def _list(records):
+    if isinstance(records, record_file.LazyRecords):
+        return records.lazy_items()
+    return list(records.items())
+
+
+def _peek(records, key):
+    if isinstance(records, record_file.LazyRecords):
+        return records.peek(key)
+    return records[key]
+
+
+class Shard(object):
+    """One partition of the database, backed by its own file and journal.
+
+    A shared shard may be changed by other processes too. Changes are then
+    made under an exclusive file lock, and refresh() catches up with the
+    changes of other processes.
+    """
+
+    def __init__(self, path, policy, use_journal, file_format=FORMAT_DOCUMENT,
+                 codec=None, shared=False):
+        if file_format not in (FORMAT_DOCUMENT, FORMAT_RECORDS):
+            raise ValueError('Unknown database format: {}'.format(file_format))
+        self.path = path
+        self.policy = policy
+        self.file_format = file_format
+        self.codec = codec or serialization.JsonCodec()
+        # Maps keys to records in the compact form of impl/database/records.py.
+        self.records = {}
+        # Guards the records dictionary, which is never mutated while it is
+        # being serialized.
+        self.lock = threading.RLock()
+        # The open snapshots of the shard, which are dropped once unused.
+        self._snapshots = weakref.WeakSet()
+        self.journal = None
+        if use_journal:
+            self.journal = journal.Journal(path + '.journal', policy,
+                                           self.codec)
+        self.file_lock = None
+        if shared:
+            self.file_lock = FileLock(path + '.lock')
+        # The version of the shard file as of the last load or commit.
+        self._signature = None
+        # The keys of the records in order, built by the first scan() and
+        # kept up to date from then on.
+        self._sorted_keys = None
+
+    def load(self):
+        """Loads the shard file, if it exists, and replays its journal.
+
+        The format and encoding of the file are detected from its header,
+        whatever the shard is configured to write. A journal written with a
+        different encoding is folded into the file straight away, so that
+        the journal never mixes encodings.
+        """
+        self._read()
+        if self.journal is not None:
+            if self.journal.encoding not in (None, self.codec.encoding):
+                self.commit()
+        return self
+
+    def _read(self):
+        self._signature = _signature(self.path)
+        self._sorted_keys = None
+        if os.path.exists(self.path):
+            header = serialization.read_header(self.path)
+            if header is not None and header[0] in record_file.LAYOUTS:
+                self.records = record_file.load(self.path, self.codec,
+                                                records.compact)
+            else:
+                self.records = self._load_document(header)
+        if self.journal is not None:
+            self.journal.replay(self.records)
+
+    def _load_document(self, header):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        encoding, header_length = 'json', 0
+        if header is not None:
+            _, encoding, header_length = header
+        codec = serialization.codec_for_encoding(encoding, self.codec)
+        return dict((key, records.compact(value))
+                    for key, value in codec.loads(data[header_length:]).items())
+
+    def changed(self):
+        """Whether another process changed the shard file or journal.
+
+        This only takes a stat() or two, so it is cheap to check often.
+        """
+        return (_signature(self.path) != self._signature or
+                (self.journal is not None and self.journal.changed()))
+
+    def refresh(self):
+        """Catches up with the changes other processes made to the shard.
+
+        Records appended to the journal are applied one by one, and returned
+        as (key, old record, new record) changes. If the shard file was
+        rewritten, or the journal replaced, the shard is loaded again and None
+        is returned. The caller holds the file lock.
+        """
+        with self.lock:
+            if _signature(self.path) == self._signature:
+                if self.journal is None:
+                    return []
+                tail = self.journal.read_tail()
+                if tail is not None:
+                    return [self._apply(record)
+                            for record in journal.flatten(tail)]
+            self._reload()
+            return None
+
+    def _apply(self, record):
+        key = record['key']
+        if record['op'] == 'write':
+            value = records.compact(record['value'])
+            return key, self.set(key, value), value
+        if key in self.records:
+            return key, self.pop(key), None
+        return key, None, None
+
+    def _reload(self):
+        # Open snapshots keep reading the records they were taken from, which
+        # are no longer changed.
+        for view in list(self._snapshots):
+            view.detach(self.records)
+        self._snapshots.clear()
+        self.records = {}
+        if self.journal is not None:
+            self.journal.close()
+        self._read()
+
+    def get(self, key):
+        with self.lock:
+            return self.records.get(key)
+
+    def set(self, key, value):
+        """Stores a record, returning the one it replaced, if any."""
+        with self.lock:
+            self._preserve(key)
+            old = self.records.get(key)
+            if old is None and self._sorted_keys is not None:
+                bisect.insort(self._sorted_keys, key)
+            self.records[key] = value
+        return old
+
+    def pop(self, key):
+        """Removes a record and returns it; the record must exist."""
+        with self.lock:
+            self._preserve(key)
+            if self._sorted_keys is not None:
+                del self._sorted_keys[bisect.bisect_left(self._sorted_keys,
+                                                         key)]
+            return self.records.pop(key)
+
+    def _preserve(self, key):
+        for view in list(self._snapshots):
+            view.preserve(key, self.records)
+
+    def snapshot(self):
+        """Returns a ShardSnapshot of the records as of now."""
+        with self.lock:
+            view = ShardSnapshot(self)
+            self._snapshots.add(view)
+        return view
+
+    def release(self, view):
+        with self.lock:
+            self._snapshots.discard(view)
+
+    def items(self):
+        """Lists the records of the shard as of now.
+
+        Lazily loaded records are only decoded as the listing is walked.
+        """
+        with self.lock:
+            return _list(self.records)
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Lists up to limit records in key order; see JsonDatabase.scan().
+
+        Lazily loaded records that were not decoded yet are decoded without
+        being kept in memory.
+        """
+        with self.lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self.records)
+            keys = key_range.select(self._sorted_keys, start_key, limit, prefix,
+                                    inclusive)
+            return [(key, _peek(self.records, key)) for key in keys]
+
+    def _dumps(self):
+        if self.file_format == FORMAT_RECORDS:
+            return record_file.dumps(self.records, self.codec)
+        data = self.codec.dumps(dict(self.items()))
+        if self.codec.encoding == 'json':
+            return data
+        return serialization.make_header(FORMAT_DOCUMENT, self.codec) + data
+
+    def disk_size(self):
+        """Returns the size of the shard file and journal, as last written."""
+        size = 0 if self._signature is None else self._signature[1]
+        if self.journal is not None:
+            size += self.journal.size
+        return size
+
+    def commit(self):
+        """Rewrites the shard file from memory and empties its journal.
+
+        The lock is held throughout, so no change can be applied after the
+        records were serialized but then dropped with the journal. Returns
+        the number of bytes written.
+        """
+        with self.lock:
+            data = self._dumps()
+            journal.atomic_write(self.path, data, self.policy.sync_on_write)
+            if self.journal is not None:
+                self.journal.reset()
+            self._signature = _signature(self.path)
+            if self.file_format == FORMAT_RECORDS:
+                self.records = record_file.load(self.path, self.codec,
+                                                records.compact)
+        return len(data)
+
+
+class ShardSnapshot(object):
+    """A point-in-time view of one shard.
+
+    Taking one copies no records. Instead, until it is released, the shard
+    hands it the previous value of each record changed after it was taken,
+    the first time the record changes, and those values take precedence over
+    the live records. Records are never mutated in place, so the view only
+    costs the records replaced while it is open.
+    """
+
+    def __init__(self, shard):
+        self._shard = shard
+        self._preserved = {}
+        # The records the view reads, if the shard has since been reloaded.
+        self._records = None
+        # The keys of the view in order, built by the first scan().
+        self._sorted_keys = None
+
+    def _live_records(self):
+        if self._records is not None:
+            return self._records
+        return self._shard.records
+
+    def preserve(self, key, live_records):
+        """Keeps the value a record had when the snapshot was taken.
+
+        Called by the shard, under its lock, before the record changes.
+        """
+        if key not in self._preserved:
+            self._preserved[key] = live_records.get(key, _MISSING)
+
+    def detach(self, live_records):
+        """Called by the shard, under its lock, before it is reloaded."""
+        self._records = live_records
+
+    def get(self, key):
+        with self._shard.lock:
+            if key in self._preserved:
+                value = self._preserved[key]
+            else:
+                value = self._live_records().get(key, _MISSING)
+        return None if value is _MISSING else value
+
+    def items(self):
+        """Lists the records of the shard as of when the snapshot was taken."""
+        with self._shard.lock:
+            live = _list(self._live_records())
+            preserved = dict(self._preserved)
+        for key, value in live:
+            if key not in preserved:
+                yield key, value
+        for key, value in preserved.items():
+            if value is not _MISSING:
+                yield key, value
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Lists up to limit records in key order as of the snapshot."""
+        with self._shard.lock:
+            live = self._live_records()
+            if self._sorted_keys is None:
+                # The records changed since the snapshot was taken are all
+                # preserved, so the other live records are as they were.
+                keys = set(key for key in live if key not in self._preserved)
+                keys.update(key for key, value in self._preserved.items()
+                            if value is not _MISSING)
+                self._sorted_keys = sorted(keys)
+            keys = key_range.select(self._sorted_keys, start_key, limit, prefix,
+                                    inclusive)
+            return [(key, self._preserved[key] if key in self._preserved
+                     else _peek(live, key)) for key in keys]
+
+    def release(self):
+        self._shard.release(self)
@@ -0,0 +1,374 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import json
+import sqlite3
+import threading
+
+from impl.common.metrics import InMemoryMetrics, timed
+from impl.database import journal
+from impl.database.change_feed import Change, ChangeCursor, ChangesExpired
+from impl.database.database import (CHANGE_FEED_ENABLED, CHANGE_FEED_RETENTION,
+                                    DATABASE_FILE, DURABILITY)
+from impl.database.index import IndexQueries, index_entries
+from impl.database import key_range
+from impl.database.versions import VersionedRecords
+
+# Bumped whenever the schema changes; see _migrate().
+_SCHEMA_VERSION = 2
+
+# The statements below are kept as constants so that every call reuses the
+# compiled statement from each connection's statement cache.
+_CREATE_TABLE = ('CREATE TABLE IF NOT EXISTS customers ('
+                 'key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+_CREATE_INDEX_TABLE = ('CREATE TABLE IF NOT EXISTS customer_index ('
+                       'name TEXT NOT NULL, value TEXT NOT NULL, '
+                       'key TEXT NOT NULL, PRIMARY KEY (name, value, key)) '
+                       'WITHOUT ROWID')
+_CREATE_CHANGES_TABLE = ('CREATE TABLE IF NOT EXISTS changes ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'key TEXT NOT NULL, old TEXT, new TEXT)')
+_SELECT = 'SELECT value FROM customers WHERE key = ?'
+_UPSERT = 'INSERT OR REPLACE INTO customers (key, value) VALUES (?, ?)'
+_DELETE = 'DELETE FROM customers WHERE key = ?'
+_INSERT_INDEX = ('INSERT OR IGNORE INTO customer_index (name, value, key) '
+                 'VALUES (?, ?, ?)')
+_DELETE_INDEX = ('DELETE FROM customer_index '
+                 'WHERE name = ? AND value = ? AND key = ?')
+_SELECT_INDEX = ('SELECT key FROM customer_index WHERE name = ? AND value = ? '
+                 'ORDER BY key')
+_INSERT_CHANGE = 'INSERT INTO changes (key, old, new) VALUES (?, ?, ?)'
+_TRIM_CHANGES = 'DELETE FROM changes WHERE seq <= ?'
+_SELECT_CHANGES = ('SELECT seq, key, old, new FROM changes WHERE seq > ? '
+                   'ORDER BY seq LIMIT ?')
+_SELECT_FIRST_PAGE = 'SELECT key, value FROM customers ORDER BY key LIMIT ?'
+_SELECT_NEXT_PAGE = ('SELECT key, value FROM customers WHERE key > ? '
+                     'ORDER BY key LIMIT ?')
+# Filled in with the comparison against the first key, and the bound on the
+# last key of a prefix scan, if any.
+_SELECT_RANGE = ('SELECT key, value FROM customers WHERE key {} ?{} '
+                 'ORDER BY key LIMIT ?')
+
+# The first bytes of every SQLite database file.
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+# SQLite's synchronous setting for each durability policy.
+_SYNCHRONOUS = {
+    journal.DURABILITY_ALWAYS: 'FULL',
+    journal.DURABILITY_INTERVAL: 'NORMAL',
+    journal.DURABILITY_OS: 'OFF',
+}
+
+# Number of records fetched at a time while iterating over the database.
+_PAGE_SIZE = 1000
+
+
+def _dumps(value):
+    return None if value is None else json.dumps(value)
+
+
+def _loads(value):
+    return None if value is None else json.loads(value)
+
+
+def _read(connection, key):
+    row = connection.execute(_SELECT, (key,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def _items(connection):
+    rows = connection.execute(_SELECT_FIRST_PAGE, (_PAGE_SIZE,)).fetchall()
+    while rows:
+        for key, value in rows:
+            yield key, json.loads(value)
+        rows = connection.execute(_SELECT_NEXT_PAGE,
+                                  (rows[-1][0], _PAGE_SIZE)).fetchall()
+
+
+def _scan(connection, start_key, limit, prefix, inclusive):
+    first, inclusive = key_range.lower_bound(start_key, prefix, inclusive)
+    last = key_range.prefix_end(prefix)
+    query = _SELECT_RANGE.format('>=' if inclusive else '>',
+                                 '' if last is None else ' AND key < ?')
+    parameters = (first,) + (() if last is None else (last,)) + (
+        -1 if limit is None else limit,)
+    return [(key, json.loads(value))
+            for key, value in connection.execute(query, parameters)]
+
+
+class SqliteDatabase(IndexQueries, VersionedRecords):
+    """SQLite-based implementation of the database, with the JsonDatabase API.
+
+    Records are stored as JSON text in a table keyed by the procurement account
+    ID, so reads and writes are B-tree lookups and opening the database does not
+    load any records. The database runs in WAL mode, so readers never block the
+    writer. Each thread uses its own connection.
+
+    Secondary index entries are kept in their own table, which is updated in
+    the same transaction as the record they point to. So are the entries of
+    the change feed, when it is enabled.
+
+    As with JsonDatabase, writes that would not change their record are
+    skipped, and counted in writes_skipped, and the latency of reads, writes,
+    deletes, updates and opening the database is measured into metrics.
+    """
+
+    def __init__(self, path=DATABASE_FILE, durability=DURABILITY,
+                 change_feed=CHANGE_FEED_ENABLED,
+                 change_feed_retention=CHANGE_FEED_RETENTION, metrics=None):
+        self.path = path
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
+        self.synchronous = _SYNCHRONOUS[durability]
+        self.change_feed = change_feed
+        self.change_feed_retention = change_feed_retention
+        self.writes_skipped = 0
+        self.changes_committed = 0
+        self._counters_lock = threading.Lock()
+        self._local = threading.local()
+        self._check_file()
+        with self.metrics.timer('load'):
+            self._migrate()
+
+    def _check_file(self):
+        """Fails clearly if the file exists but is not an SQLite database.
+
+        The codelab has the JSON database file populated with {}, which
+        SQLite would only reject with "file is not a database".
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(len(_SQLITE_HEADER))
+        except (IOError, OSError):
+            return
+        if header and header != _SQLITE_HEADER:
+            raise ValueError(
+                '{} is not an SQLite database. The sqlite and tiered backends '
+                'create the database file themselves, so point '
+                'PROCUREMENT_CODELAB_DATABASE at a file that does not exist '
+                'yet. To move the records of a JSON database over, export '
+                'them with impl.database.backup and import them into the new '
+                'database.'.format(self.path))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous={}'.format(self.synchronous))
+            self._local.connection = connection
+        return connection
+
+    def _migrate(self):
+        """Creates the tables, indexing any records stored before the index."""
+        with self._write_transaction() as connection:
+            connection.execute(_CREATE_TABLE)
+            connection.execute(_CREATE_INDEX_TABLE)
+            connection.execute(_CREATE_CHANGES_TABLE)
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                for key, value in connection.execute(
+                        'SELECT key, value FROM customers').fetchall():
+                    self._update_index(connection, key, None, json.loads(value))
+            connection.execute('PRAGMA user_version={}'.format(_SCHEMA_VERSION))
+
+    @contextlib.contextmanager
+    def _write_transaction(self):
+        """Runs the enclosed statements in a single write transaction.
+
+        A transaction started while another is open on the same thread joins
+        the outer one, which commits or rolls back all of their changes.
+        """
+        connection = self._connection()
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            connection.execute('BEGIN IMMEDIATE')
+        self._local.depth = depth + 1
+        try:
+            yield connection
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                connection.execute('ROLLBACK')
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            connection.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits the writes and deletes made within on this thread together.
+
+        If the block raises an exception, nothing is changed. A transaction
+        started within another joins it.
+        """
+        with self._write_transaction():
+            yield
+
+    def _update_index(self, connection, key, old, new):
+        old_entries = index_entries(old)
+        new_entries = index_entries(new)
+        for name, value in old_entries - new_entries:
+            connection.execute(_DELETE_INDEX, (name, value, key))
+        for name, value in new_entries - old_entries:
+            connection.execute(_INSERT_INDEX, (name, value, key))
+
+    def _index_keys(self, name, value):
+        rows = self._connection().execute(_SELECT_INDEX, (name, value))
+        return [row[0] for row in rows.fetchall()]
+
+    @timed('read')
+    def read(self, key):
+        """Read the record with the given key from the database, if it exists."""
+        return _read(self._connection(), key)
+
+    @timed('write')
+    def write(self, key, value):
+        """Write the record with the given key to the database."""
+        with self._write_transaction() as connection:
+            old = self.read(key)
+            if old is not None and old == value:
+                self._count(skipped=1)
+                return
+            self._update_index(connection, key, old, value)
+            connection.execute(_UPSERT, (key, json.dumps(value)))
+            self._publish(connection, key, old, value)
+        self._count(committed=1)
+
+    @timed('delete')
+    def delete(self, key):
+        """Delete the record with the given key from the database, if it exists."""
+        with self._write_transaction() as connection:
+            old = self.read(key)
+            if old is None:
+                return
+            self._update_index(connection, key, old, None)
+            connection.execute(_DELETE, (key,))
+            self._publish(connection, key, old, None)
+        self._count(committed=1)
+
+    def _count(self, skipped=0, committed=0):
+        with self._counters_lock:
+            self.writes_skipped += skipped
+            self.changes_committed += committed
+        if skipped:
+            self.metrics.increment('writes_skipped', skipped)
+        if committed:
+            self.metrics.increment('changes_committed', committed)
+
+    def _publish(self, connection, key, old, new):
+        if not self.change_feed:
+            return
+        seq = connection.execute(_INSERT_CHANGE, (key, _dumps(old),
+                                                  _dumps(new))).lastrowid
+        connection.execute(_TRIM_CHANGES, (seq - self.change_feed_retention,))
+
+    def changes(self, since=0):
+        """Returns a ChangeCursor over the changes made after the given one.
+
+        Pass the seq of a cursor saved earlier to resume where it stopped.
+        """
+        if not self.change_feed:
+            raise ValueError('The change feed is not enabled.')
+        return ChangeCursor(self, since)
+
+    def read_changes(self, seq, limit=None):
+        """Returns up to limit changes made after the one numbered seq.
+
+        Raises ChangesExpired if some of them were already discarded.
+        """
+        rows = self._connection().execute(
+            _SELECT_CHANGES, (seq, -1 if limit is None else limit)).fetchall()
+        # Sequence numbers have no gaps, as a rolled back transaction also
+        # rolls back the numbers it took.
+        if rows and rows[0][0] != seq + 1:
+            raise ChangesExpired(
+                'Changes after {} were discarded; the oldest kept is {}.'
+                .format(seq, rows[0][0]))
+        return [Change(row[0], row[1], _loads(row[2]), _loads(row[3]))
+                for row in rows]
+
+    @timed('update')
+    def update(self, key, fn):
+        """Atomically replaces the record with the given key with fn(record).
+
+        fn receives the current record, or None if it does not exist, and
+        returns the record to write. If it returns None, the record is left
+        unchanged. The read and write happen in one write transaction.
+        """
+        with self._write_transaction():
+            value = fn(self.read(key))
+            if value is not None:
+                self.write(key, value)
+        return value
+
+    def items(self):
+        """Provides a way to iterate over all elements in the database.
+
+        Records are fetched a page at a time in key order, so records may be
+        written while iterating. Use snapshot() for a consistent view.
+        """
+        return _items(self._connection())
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order, as (key, record) pairs.
+
+        See JsonDatabase.scan().
+        """
+        return _scan(self._connection(), start_key, limit, prefix, inclusive)
+
+    def snapshot(self):
+        """Returns a consistent SqliteSnapshot of the database as of now."""
+        return SqliteSnapshot(self.path)
+
+
+class SqliteSnapshot(object):
+    """An immutable point-in-time view of the SQLite database.
+
+    The view is a read transaction on a connection of its own. In WAL mode it
+    keeps seeing the database as of its first read, without blocking the
+    writer, until it is closed.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute('BEGIN')
+        # The transaction only takes its snapshot on its first read.
+        _read(self._connection, '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, key):
+        """Read the record with the given key as of the snapshot, if it existed."""
+        return _read(self._connection, key)
+
+    def items(self):
+        """Provides a way to iterate over all elements as of the snapshot."""
+        return _items(self._connection)
+
+    def scan(self, start_key=None, limit=None, prefix='', inclusive=True):
+        """Returns up to limit records in key order as of the snapshot."""
+        return _scan(self._connection, start_key, limit, prefix, inclusive)
+
+    def close(self):
+        self._connection.execute('ROLLBACK')
+        self._connection.close()
@@ -0,0 +1,205 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from impl.common.metrics import timed
+from impl.database.bloom import BloomFilter
+from impl.database.change_feed import ChangesExpired
+from impl.database.database import (CHANGE_FEED_RETENTION, DATABASE_FILE,
+                                    DURABILITY)
+from impl.database import records
+from impl.database.sqlite_database import SqliteDatabase, _read
+
+# Maximum number of records the tiered backend keeps in memory.
+HOT_RECORDS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_HOT_RECORDS', 10000))
+
+# How often the tiered backend checks whether other processes changed records.
+# Changes made by this process are seen immediately.
+HOT_REFRESH_MS = int(
+    os.environ.get('PROCUREMENT_CODELAB_DATABASE_HOT_REFRESH_MS', 100))
+
+# The bloom filter is sized for twice the number of keys when it is built, and
+# for at least this many.
+_MIN_BLOOM_CAPACITY = 1024
+
+_COUNT_KEYS = 'SELECT COUNT(*) FROM customers'
+_SELECT_KEYS = 'SELECT key FROM customers'
+_SELECT_LAST_SEQ = 'SELECT MAX(seq) FROM changes'
+
+# Number of changes read at a time while catching up with other connections.
+_CATCH_UP_PAGE_SIZE = 1000
+
+
+class TieredDatabase(SqliteDatabase):
+    """An SQLite database with the recently read records kept in memory.
+
+    Every record is stored in SQLite, the cold tier. The hot tier keeps the
+    most recently read records, in their compact form, up to max_hot_records
+    of them, so memory tracks the working set rather than the number of
+    customers. A bloom filter of every key answers reads of keys that do not
+    exist, such as entitlement messages arriving before their account, without
+    querying SQLite.
+
+    Records changed by this process are dropped from the hot tier as their
+    change commits. The change feed is always enabled, and every
+    refresh_interval_ms it is checked for the changes of other processes, to
+    drop their records from the hot tier and add their keys to the bloom
+    filter. Reads within a transaction, such as those of update() and
+    write_if_version(), items(), scan() and snapshots go straight to SQLite,
+    so they never see stale records nor push the working set out of memory.
+    """
+
+    def __init__(self, path=DATABASE_FILE, durability=DURABILITY,
+                 change_feed_retention=CHANGE_FEED_RETENTION,
+                 max_hot_records=HOT_RECORDS,
+                 refresh_interval_ms=HOT_REFRESH_MS, metrics=None):
+        self.max_hot_records = max_hot_records
+        self.refresh_interval = refresh_interval_ms / 1000.0
+        # Maps keys to compact records, least recently read first.
+        self._hot = collections.OrderedDict()
+        # Bumped whenever a record is dropped from the hot tier. A record read
+        # from SQLite is only kept if none was dropped meanwhile, as it may be
+        # the old value of a change committed in between.
+        self._evictions = 0
+        self._bloom = None
+        # The sequence number of the last change the hot tier caught up with.
+        self._seq = 0
+        self._lock = threading.Lock()
+        super(TieredDatabase, self).__init__(
+            path, durability, change_feed=True,
+            change_feed_retention=change_feed_retention, metrics=metrics)
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        """Empties the hot tier and builds the bloom filter from every key."""
+        connection = self._connection()
+        self._seq = connection.execute(_SELECT_LAST_SEQ).fetchone()[0] or 0
+        self._hot.clear()
+        self._evictions += 1
+        self._build_bloom(connection)
+
+    def _build_bloom(self, connection):
+        count = connection.execute(_COUNT_KEYS).fetchone()[0]
+        bloom = BloomFilter(max(2 * count, _MIN_BLOOM_CAPACITY))
+        for row in connection.execute(_SELECT_KEYS):
+            bloom.add(row[0])
+        self._bloom = bloom
+
+    def _add_key(self, key):
+        if self._bloom is None or key in self._bloom:
+            return
+        if self._bloom.count >= self._bloom.capacity:
+            self._build_bloom(self._connection())
+        self._bloom.add(key)
+
+    def _evict(self, keys):
+        with self._lock:
+            for key in keys:
+                self._hot.pop(key, None)
+            self._evictions += 1
+
+    def _catch_up(self):
+        """Applies the changes other connections committed since last time.
+
+        PRAGMA data_version only changes when another connection committed,
+        and costs no I/O, but still about as much as reading a record, so each
+        thread only checks it once per refresh interval.
+        """
+        now = time.time()
+        if now < getattr(self._local, 'next_refresh', 0):
+            return
+        self._local.next_refresh = now + self.refresh_interval
+        connection = self._connection()
+        version = connection.execute('PRAGMA data_version').fetchone()[0]
+        if version == getattr(self._local, 'data_version', None):
+            return
+        self._local.data_version = version
+        with self._lock:
+            try:
+                while True:
+                    changes = self.read_changes(self._seq, _CATCH_UP_PAGE_SIZE)
+                    for change in changes:
+                        self._hot.pop(change.key, None)
+                        if change.new is not None:
+                            self._add_key(change.key)
+                    if changes:
+                        self._seq = changes[-1].seq
+                        self._evictions += 1
+                    if len(changes) < _CATCH_UP_PAGE_SIZE:
+                        break
+            except ChangesExpired:
+                self._reset()
+
+    @timed('read')
+    def read(self, key):
+        """Read the record with the given key from the database, if it exists.
+
+        Reads are also counted by where they were answered: hot_reads from
+        memory, absent_reads by the bloom filter and cold_reads by SQLite.
+        """
+        if getattr(self._local, 'depth', 0):
+            return _read(self._connection(), key)
+        self._catch_up()
+        with self._lock:
+            value = self._hot.pop(key, None)
+            if value is not None:
+                self._hot[key] = value
+                self.metrics.increment('hot_reads')
+                return records.expand(value)
+            if key not in self._bloom:
+                self.metrics.increment('absent_reads')
+                return None
+            evictions = self._evictions
+        self.metrics.increment('cold_reads')
+        value = _read(self._connection(), key)
+        if value is not None:
+            self._keep(key, records.compact(value), evictions)
+        return value
+
+    def _keep(self, key, value, evictions):
+        with self._lock:
+            if self._evictions != evictions:
+                return
+            self._hot[key] = value
+            while len(self._hot) > self.max_hot_records:
+                self._hot.popitem(last=False)
+
+    @contextlib.contextmanager
+    def _write_transaction(self):
+        """Drops the records changed by the transaction once it is done."""
+        outermost = not getattr(self._local, 'depth', 0)
+        if outermost:
+            self._local.changed = []
+        try:
+            with super(TieredDatabase, self)._write_transaction() as connection:
+                yield connection
+        finally:
+            if outermost:
+                self._evict(self._local.changed)
+
+    def _publish(self, connection, key, old, new):
+        super(TieredDatabase, self)._publish(connection, key, old, new)
+        self._local.changed.append(key)
+        # The key is added before the record is committed, so that no reader
+        # can see the record but miss the key.
+        if new is not None:
+            with self._lock:
+                self._add_key(key)
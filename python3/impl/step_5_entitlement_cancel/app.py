@@ -18,11 +18,13 @@ import pprint
 import sys
 import uuid
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.cloud import pubsub_v1
 
-from impl.database.database import JsonDatabase
+from impl.client.batch import RequestBatcher
+from impl.client.cache import ResponseCache
+from impl.client.discovery import build_service
+from impl.database.database import open_database
 
 PROJECT_ID = os.environ['GOOGLE_CLOUD_PROJECT']
 
@@ -40,8 +42,32 @@ class Procurement(object):
     """Utilities for interacting with the Procurement API."""
 
     def __init__(self, database):
-        self.service = build(PROCUREMENT_API, 'v1', cache_discovery=False)
+        self.service = build_service(PROCUREMENT_API, 'v1')
         self.database = database
+        # Recently fetched accounts and entitlements; see
+        # impl/client/cache.py.
+        self.cache = ResponseCache()
+        # Sends the requests of concurrent handlers together; see
+        # impl/client/batch.py.
+        self.batcher = RequestBatcher(self.service.new_batch_http_request)
+
+    def _get(self, name, request, update_time):
+        """Executes a get request, or returns the cached resource.
+
+        Returns None if the resource was not found, which is cached too.
+        """
+        def fetch():
+            try:
+                return self.batcher.execute(request)
+            except HttpError as err:
+                if err.resp.status == 404:
+                    return None
+                raise
+
+        try:
+            return self.cache.get(name, fetch, update_time)
+        except HttpError:
+            return None
 
     ##########################
     ### Account operations ###
@@ -54,31 +80,31 @@ class Procurement(object):
         return 'providers/DEMO-{}/accounts/{}'.format(PROJECT_ID,
                                                       account_id)
 
-    def get_account(self, account_id):
-        """Gets an account from the Procurement Service."""
+    def get_account(self, account_id, update_time=None):
+        """Gets an account from the Procurement Service.
+
+        update_time is the time of the message being handled, if any. A
+        cached account that may be older is fetched again.
+        """
         name = self._get_account_name(account_id)
         request = self.service.providers().accounts().get(name=name)
-        try:
-            response = request.execute()
-            return response
-        except HttpError as err:
-            if err.resp.status == 404:
-                return None
+        return self._get(name, request, update_time)
 
     def approve_account(self, account_id):
         """Approves the account in the Procurement Service."""
         name = self._get_account_name(account_id)
         request = self.service.providers().accounts().approve(
             name=name, body={'approvalName': 'signup'})
-        request.execute()
+        self.batcher.execute(request)
+        self.cache.invalidate(name)
 
     def handle_account_message(self, message):
         """Handles incoming Pub/Sub messages about account resources."""
 
         account_id = message['id']
 
-        customer = self.database.read(account_id)
-        account = self.get_account(account_id)
+        customer, version = self.database.read_with_version(account_id)
+        account = self.get_account(account_id, message.get('updateTime'))
 
         ############################## IMPORTANT ##############################
         ### In true integrations, Pub/Sub messages for new accounts should  ###
@@ -110,7 +136,12 @@ class Procurement(object):
                         'internal_account_id': internal_id,
                         'products': {}
                     }
-                    self.database.write(account_id, customer)
+                    # Only write if no other message changed the record
+                    # since it was read. Otherwise, don't ack the message, so
+                    # that it is handled again from the current record.
+                    if not self.database.write_if_version(
+                            account_id, customer, version):
+                        return False
             else:
                 # The account has been deleted, so delete the database record.
                 if customer:
@@ -127,23 +158,23 @@ class Procurement(object):
         return 'providers/DEMO-{}/entitlements/{}'.format(PROJECT_ID,
                                                           entitlement_id)
 
-    def get_entitlement(self, entitlement_id):
-        """Gets an entitlement from the Procurement Service."""
+    def get_entitlement(self, entitlement_id, update_time=None):
+        """Gets an entitlement from the Procurement Service.
+
+        update_time is the time of the message being handled, if any. A
+        cached entitlement that may be older is fetched again.
+        """
         name = self._get_entitlement_name(entitlement_id)
         request = self.service.providers().entitlements().get(name=name)
-        try:
-            response = request.execute()
-            return response
-        except HttpError as err:
-            if err.resp.status == 404:
-                return None
+        return self._get(name, request, update_time)
 
     def approve_entitlement(self, entitlement_id):
         """Approves the entitlement in the Procurement Service."""
         name = self._get_entitlement_name(entitlement_id)
         request = self.service.providers().entitlements().approve(
             name=name, body={})
-        request.execute()
+        self.batcher.execute(request)
+        self.cache.invalidate(name)
 
     def approve_entitlement_plan_change(self, entitlement_id, new_pending_plan):
         """Approves the entitlement plan change in the Procurement Service."""
@@ -151,9 +182,10 @@ class Procurement(object):
         body = {'pendingPlanName': new_pending_plan}
         request = self.service.providers().entitlements().approvePlanChange(
             name=name, body=body)
-        request.execute()
+        self.batcher.execute(request)
+        self.cache.invalidate(name)
 
-    def handle_active_entitlement(self, entitlement, customer, account_id):
+    def handle_active_entitlement(self, entitlement, account_id):
         """Updates the database to match the active entitlement."""
         product = {
             'product_id': entitlement['product'],
@@ -164,16 +196,20 @@ class Procurement(object):
         if 'usageReportingId' in entitlement:
             product['consumer_id'] = entitlement['usageReportingId']
 
-        customer['products'][entitlement['product']] = product
+        def add_product(customer):
+            if customer:
+                customer['products'][entitlement['product']] = product
+            return customer
 
         ### TODO: Set up the service for the customer to use. ###
-        self.database.write(account_id, customer)
+        self.database.update(account_id, add_product)
 
     def handle_entitlement_message(self, message, event_type):
         """Handles incoming Pub/Sub messages about entitlement resources."""
         entitlement_id = message['id']
 
-        entitlement = self.get_entitlement(entitlement_id)
+        entitlement = self.get_entitlement(entitlement_id,
+                                           message.get('updateTime'))
 
         if not entitlement:
             # Do nothing. The entitlement has to be canceled to be deleted, so
@@ -202,8 +238,7 @@ class Procurement(object):
         elif event_type == 'ENTITLEMENT_ACTIVE':
             if state == 'ENTITLEMENT_ACTIVE':
                 # Handle an active entitlement by writing to the database.
-                self.handle_active_entitlement(entitlement, customer,
-                                               account_id)
+                self.handle_active_entitlement(entitlement, account_id)
                 return True
 
         elif event_type == 'ENTITLEMENT_PLAN_CHANGE_REQUESTED':
@@ -217,8 +252,7 @@ class Procurement(object):
         elif event_type == 'ENTITLEMENT_PLAN_CHANGED':
             if state == 'ENTITLEMENT_ACTIVE':
                 # Handle an active entitlement after a plan change.
-                self.handle_active_entitlement(entitlement, customer,
-                                               account_id)
+                self.handle_active_entitlement(entitlement, account_id)
                 return True
 
         elif event_type == 'ENTITLEMENT_PLAN_CHANGE_CANCELLED':
@@ -230,10 +264,14 @@ class Procurement(object):
             if state == 'ENTITLEMENT_CANCELLED':
                 # Clear out our records of the customer's plan.
                 if entitlement['product'] in customer['products']:
-                    del customer['products'][entitlement['product']]
+                    def remove_product(customer):
+                        if customer:
+                            customer['products'].pop(entitlement['product'],
+                                                     None)
+                        return customer
 
                     ### TODO: Turn off customer's service. ###
-                    self.database.write(account_id, customer)
+                    self.database.update(account_id, remove_product)
                 return True
 
         elif event_type == 'ENTITLEMENT_PENDING_CANCELLATION':
@@ -262,7 +300,7 @@ def main(argv):
         return
 
     # Construct a service for the Partner Procurement API.
-    database = JsonDatabase()
+    database = open_database()
     procurement = Procurement(database)
 
     # Get the subscription object in order to perform actions on it.
@@ -17,13 +17,16 @@ import os
 import sys
 import uuid
 
-from googleapiclient.discovery import build, build_from_document
-
-from impl.database.database import JsonDatabase
+from impl.client.discovery import build_service
+from impl.database.database import open_database
 
 STAGING_DISCOVERY_FILE = 'staging_servicecontrol_discovery.json'
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+# Number of customers reported on between recording report times. A failed run
+# sends the reports of at most this many customers again on the next run.
+REPORT_BATCH_SIZE = 100
+
 
 # Attribute the cost associated with this `operation` to the given `resource_name` within the given `container_name`
 def _add_cost_attribution(operation, container_name, resource_name):
@@ -52,6 +55,25 @@ def _get_staging_discovery():
         return f.read()
 
 
+def _set_last_report_time(product_id, end_time):
+    def set_last_report_time(customer):
+        # The product may have been cancelled since the snapshot was taken.
+        if not customer or product_id not in customer['products']:
+            return None
+        customer['products'][product_id]['last_report_time'] = end_time
+        return customer
+
+    return set_last_report_time
+
+
+def _record_report_times(database, reported):
+    """Records when each product was reported on, in a single transaction."""
+    with database.transaction():
+        for customer_id, product_id, end_time in reported:
+            database.update(customer_id,
+                            _set_last_report_time(product_id, end_time))
+
+
 def main(argv):
     """Sends usage reports to Google Service Control for all users."""
 
@@ -61,57 +83,71 @@ def main(argv):
 
     service_name = argv[1]
 
-    service = build('servicecontrol', 'v1')
-
-    database = JsonDatabase()
-
-    for customer_id, customer in database.items():
-        for product_id, product in customer['products'].items():
-            if 'consumer_id' not in product:
-                continue
-            end_time = datetime.datetime.utcnow().strftime(TIME_FORMAT)
-            start_time = None
-            if 'last_report_time' in product:
-                start_time = product['last_report_time']
-            else:
-                start_time = product['start_time']
-            metric_plan_name = product['plan_id'].replace('-', '_')
-            operation = {
-                'operationId': str(uuid.uuid4()),
-                'operationName': 'Codelab Usage Report',
-                'consumerId': product['consumer_id'],
-                'startTime': start_time,
-                'endTime': end_time,
-                'metricValueSets': [{
-                    'metricName': '%s/%s_requests' % (service_name,
-                                                      metric_plan_name),
-                    'metricValues': [{
-                        'int64Value': _get_usage_for_product(),
-                    }],
-                }]
-            }
-            check = service.services().check(
-                serviceName=service_name, body={
-                    'operation': operation
-                }).execute()
-
-            if 'checkErrors' in check:
-                print('Errors for user %s with product %s:' % (customer_id,
-                                                               product_id))
-                print(check['checkErrors'])
-                ### TODO: Temporarily turn off service for the user. ###
-                continue
-
-            # userLabels are only allowed in report()
-            # Attribute the current cost of this report to the `products_db` resource
-            _add_cost_attribution(operation, 'saas-storage-solutions', 'products_db')
+    service = build_service('servicecontrol', 'v1')
+
+    database = open_database()
+
+    # Reports are sent for the customers as of a snapshot, so that changes made
+    # meanwhile by the listener neither disturb the scan nor get overwritten.
+    # The customers are paged through in key order.
+    with database.snapshot() as snapshot:
+        batch = snapshot.scan(limit=REPORT_BATCH_SIZE)
+        while batch:
+            reported = []
+            # The report times of the products reported on are recorded even
+            # if a later report fails, as Service Control already accepted
+            # them, and sending them again would bill them twice.
+            try:
+                for customer_id, customer in batch:
+                    for product_id, product in customer['products'].items():
+                        if 'consumer_id' not in product:
+                            continue
+                        end_time = datetime.datetime.utcnow().strftime(TIME_FORMAT)
+                        start_time = None
+                        if 'last_report_time' in product:
+                            start_time = product['last_report_time']
+                        else:
+                            start_time = product['start_time']
+                        metric_plan_name = product['plan_id'].replace('-', '_')
+                        operation = {
+                            'operationId': str(uuid.uuid4()),
+                            'operationName': 'Codelab Usage Report',
+                            'consumerId': product['consumer_id'],
+                            'startTime': start_time,
+                            'endTime': end_time,
+                            'metricValueSets': [{
+                                'metricName': '%s/%s_requests' % (service_name,
+                                                                  metric_plan_name),
+                                'metricValues': [{
+                                    'int64Value': _get_usage_for_product(),
+                                }],
+                            }]
+                        }
+                        check = service.services().check(
+                            serviceName=service_name, body={
+                                'operation': operation
+                            }).execute()
+
+                        if 'checkErrors' in check:
+                            print('Errors for user %s with product %s:' % (customer_id,
+                                                                           product_id))
+                            print(check['checkErrors'])
+                            ### TODO: Temporarily turn off service for the user. ###
+                            continue
+
+                        # userLabels are only allowed in report()
+                        # Attribute the current cost of this report to the `products_db` resource
+                        _add_cost_attribution(operation, 'saas-storage-solutions', 'products_db')
             
-            service.services().report(
-                serviceName=service_name, body={
-                    'operations': [operation]
-                }).execute()
-            product['last_report_time'] = end_time
-            database.write(customer_id, customer)
+                        service.services().report(
+                            serviceName=service_name, body={
+                                'operations': [operation]
+                            }).execute()
+                        reported.append((customer_id, product_id, end_time))
+            finally:
+                _record_report_times(database, reported)
+            batch = snapshot.scan(batch[-1][0], REPORT_BATCH_SIZE,
+                                  inclusive=False)
 
 
 if __name__ == '__main__':